@@ -1,4 +1,7 @@
+import functools
+
 from src.database.model import Model
+from src.database.user_session import UserSession
 from src.dataobjects import ViewCallbacks
 from src.gui.view import View
 
@@ -6,8 +9,12 @@ from src.gui.view import View
 class Controller:
     def __init__(self, config: dict[str, any]) -> None:
         config_databases = config.pop("redis")
-        
-        self.model = Model(config_databases)
+        config_snippets = config.pop("snippets", dict())
+
+        self.model = Model(
+            config_databases,
+            bot_ratio=config_snippets.get("bot_ratio"), prefetch_workers=config_snippets.get("prefetch_workers", 8)
+        )
         self.view = View()
 
         view_callbacks = ViewCallbacks(
@@ -25,7 +32,11 @@ class Controller:
             self.model.users.make_friends,
             self.model.users.remove_friendship,
             self.model.users.get_user_by_id,
-            self.model.invitations.remove_invitation_link
+            self.model.invitations.remove_invitation_link,
+            self.model.snippets.create_prefetcher,
+            functools.partial(UserSession, self.model.users.save_user_state, self.model.markers.update_markers_batch),
+            self.model.users.get_leaderboard,
+            self.model.users.get_friends_leaderboard
         )
 
         self.view.set_callbacks(view_callbacks)
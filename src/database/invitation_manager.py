@@ -17,22 +17,18 @@ class InvitationManager:
         invitation_hash = int_to_base36(hash(str(invitation_id)))
         invitation_key = f"invitation:{invitation_hash}"
 
-        self.redis.set(invitation_key, user.db_id)
-        self.redis.expire(invitation_key, self.expiration_seconds)
+        self.redis.set(invitation_key, user.db_id, ex=self.expiration_seconds)
 
         return invitation_hash
 
     def get_invitee_id(self, invitation_hash: str) -> int | None:
         invitation_key = f"invitation:{invitation_hash}"
-        if not self.redis.exists(invitation_key):
+        invitee_id = self.redis.get(invitation_key)
+        if invitee_id is None:
             return None
 
-        invitee_id = int(self.redis.get(invitation_key))
-        return invitee_id
+        return int(invitee_id)
 
     def remove_invitation_link(self, invitation_hash: str) -> None:
         invitation_key = f"invitation:{invitation_hash}"
-        if not self.redis.exists(invitation_key):
-            return
-
         self.redis.delete(invitation_key)
@@ -17,13 +17,9 @@ class MarkerManager:
 
     def evict_markers(self) -> None:
         """Ensures that the total number of markers does not exceed max_markers."""
-        current_marker_count = self.redis.zcard("total_count_sortedset")
-        if self._max_markers < current_marker_count:
-            # Evict least frequently used markers
-            markers_to_evict = self.redis.zrange(
-                "total_count_sortedset", 0, current_marker_count - self._max_markers - 1
-            )
-
+        # Everything below the max_markers most frequently used markers, empty if within the limit
+        markers_to_evict = self.redis.zrange("total_count_sortedset", 0, -self._max_markers - 1)
+        if 0 < len(markers_to_evict):
             with self.redis.pipeline() as pipe:
                 for marker in markers_to_evict:
                     marker = marker.decode("utf-8")  # Decode for consistency in usage
@@ -41,17 +37,14 @@ class MarkerManager:
         the markers most often successfully used to identify bots, along with their
         respective success ratios. Only includes markers with at least min_count total uses.
         """
-        # Fetch markers with at least min_count uses
-        qualified_markers = set(
-            marker.decode('utf-8')
-            for marker, _ in self.redis.zrangebyscore(
-                "total_count_sortedset", min_count, "+inf", withscores=True, start=0, num=n)
-        )
-
-        # Fetch top n markers based on success ratio
-        successful_markers = self.redis.zrevrangebyscore(
-            "correct_ratio_sortedset", 1, 0, withscores=True
-        )
+        with self.redis.pipeline(transaction=False) as pipe:
+            # Fetch markers with at least min_count uses
+            pipe.zrangebyscore("total_count_sortedset", min_count, "+inf", withscores=True, start=0, num=n)
+            # Fetch top n markers based on success ratio
+            pipe.zrevrangebyscore("correct_ratio_sortedset", 1, 0, withscores=True)
+            counted_markers, successful_markers = pipe.execute()
+
+        qualified_markers = set(marker.decode('utf-8') for marker, _ in counted_markers)
 
         # Filter to include only those with sufficient total uses
         return {
@@ -66,17 +59,14 @@ class MarkerManager:
         the markers most often unsuccessfully used to identify bots, along with their
         respective failure ratios. Only includes markers with at least min_count total uses.
         """
-        # Fetch markers with at least min_count uses
-        qualified_markers = set(
-            marker.decode('utf-8')
-            for marker, _ in self.redis.zrangebyscore(
-                "total_count_sortedset", min_count, "+inf", withscores=True, start=0, num=n)
-        )
-
-        # Fetch bottom n markers based on success ratio
-        unsuccessful_markers = self.redis.zrangebyscore(
-            "correct_ratio_sortedset", 0, 1, withscores=True
-        )
+        with self.redis.pipeline(transaction=False) as pipe:
+            # Fetch markers with at least min_count uses
+            pipe.zrangebyscore("total_count_sortedset", min_count, "+inf", withscores=True, start=0, num=n)
+            # Fetch bottom n markers based on success ratio
+            pipe.zrangebyscore("correct_ratio_sortedset", 0, 1, withscores=True)
+            counted_markers, unsuccessful_markers = pipe.execute()
+
+        qualified_markers = set(marker.decode('utf-8') for marker, _ in counted_markers)
 
         # Filter to include only those with sufficient total uses
         return {
@@ -86,16 +76,25 @@ class MarkerManager:
         }
 
     def update_markers(self, markers: Counter, correct: bool) -> None:
-        correct_int = int(correct)
+        self.update_markers_batch([(markers, correct)])
+
+    def update_markers_batch(self, updates: list[tuple[Counter, bool]]) -> None:
+        # several rounds are summed up per marker, so they cost as much as a single one
+        total_counts = Counter()
+        correct_counts = Counter()
+        for each_markers, each_correct in updates:
+            total_counts.update(each_markers)
+            correct_counts.update({each_marker: int(each_correct) for each_marker in each_markers})
+
         with self.redis.pipeline() as pipe:
-            for marker_name, marker_count in markers.items():
+            for marker_name, marker_count in total_counts.items():
                 marker_key = f"marker:{marker_name}"
                 pipe.hincrby(marker_key, "total_count", marker_count)
-                pipe.hincrby(marker_key, "correct", correct_int)
+                pipe.hincrby(marker_key, "correct", correct_counts[marker_name])
 
             counts = pipe.execute()
 
-            for i, marker_name in enumerate(markers):
+            for i, marker_name in enumerate(total_counts):
                 total_count = counts[i * 2]
                 correct_count = counts[i * 2 + 1]
                 if 0 >= total_count:
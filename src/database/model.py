@@ -5,13 +5,17 @@ from src.database.user_manager import UserManager
 
 
 class Model:
-    def __init__(self, redis_config: dict[str, any]) -> None:
+    def __init__(
+            self, redis_config: dict[str, any], bot_ratio: float | None = None, prefetch_workers: int = 8) -> None:
         users_db_config = redis_config.pop("users_database")
         snippets_db_config = redis_config.pop("snippets_database")
         markers_db_config = redis_config.pop("markers_database")
         invitations_db_config = redis_config.pop("invitations_database")
 
         self.users = UserManager(users_db_config)
-        self.snippets = SnippetManager(snippets_db_config)
+        self.snippets = SnippetManager(
+            snippets_db_config, bot_ratio=bot_ratio, progress_expiration_seconds=self.users.expiration_seconds,
+            prefetch_workers=prefetch_workers
+        )
         self.markers = MarkerManager(markers_db_config, max_markers=100)
         self.invitations = InvitationManager(invitations_db_config)
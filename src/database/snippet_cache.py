@@ -0,0 +1,91 @@
+# coding=utf-8
+import sys
+import threading
+from collections import OrderedDict
+
+from src.dataobjects import Snippet
+
+
+class SnippetCache:
+    @staticmethod
+    def snippet_size(snippet: Snippet) -> int:
+        # approximation of the memory held by a decoded snippet, strings dominate
+        metadata = dict(snippet.metadata)
+        size = sys.getsizeof(snippet.text) + sys.getsizeof(snippet.source) + sys.getsizeof(metadata)
+        for each_key, each_value in metadata.items():
+            size += sys.getsizeof(each_key) + sys.getsizeof(each_value)
+        size += sys.getsizeof(snippet.tokens) + sum(sys.getsizeof(each_token) for each_token in snippet.tokens)
+        return size
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024) -> None:
+        if 0 > max_bytes:
+            raise ValueError("Cache size must not be negative.")
+
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries: OrderedDict[int, tuple[Snippet, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+        }
+
+    def get(self, snippet_id: int) -> Snippet | None:
+        with self._lock:
+            entry = self._entries.get(snippet_id)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(snippet_id)
+            self.hits += 1
+            snippet, _ = entry
+            return snippet
+
+    def put(self, snippet_id: int, snippet: Snippet) -> None:
+        size = SnippetCache.snippet_size(snippet)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(snippet_id, None)
+            if previous is not None:
+                self.current_bytes -= previous[1]
+
+            self._entries[snippet_id] = snippet, size
+            self.current_bytes += size
+
+            # least recently used entries go first
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+                self.evictions += 1
+
+    def snippet_ids(self) -> tuple[int, ...]:
+        with self._lock:
+            return tuple(self._entries)
+
+    def invalidate(self, snippet_id: int) -> None:
+        with self._lock:
+            entry = self._entries.pop(snippet_id, None)
+            if entry is not None:
+                self.current_bytes -= entry[1]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
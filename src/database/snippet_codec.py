@@ -0,0 +1,248 @@
+# coding=utf-8
+import itertools
+import operator
+import struct
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Iterable
+
+from src.dataobjects import TOKEN
+
+# version byte, flags, dictionary id
+_HEADER = struct.Struct(">BBH")
+_LENGTH = struct.Struct(">I")
+_INTEGER = struct.Struct(">q")
+
+_FLAG_BOT = 1
+_FLAG_TOKENS = 2
+
+_TYPE_STRING = 0
+_TYPE_INTEGER = 1
+
+
+class SnippetCodec(ABC):
+    name: str = ""
+    version: int = 0
+
+    def __init__(self, dictionaries: dict[int, bytes] | None = None, dictionary_id: int = 0) -> None:
+        self.dictionaries = dict() if dictionaries is None else dictionaries
+        if 0 < dictionary_id and dictionary_id not in self.dictionaries:
+            raise KeyError(f"Dictionary {dictionary_id} is unknown.")
+
+        self.dictionary_id = dictionary_id
+
+    @abstractmethod
+    def encode(
+            self, text: str, source: str, is_bot: bool, metadata: dict[str, str | int],
+            tokens: tuple[TOKEN, ...]) -> bytes:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def decode(self, record: bytes) -> tuple[str, str, bool, dict[str, str | int], tuple[TOKEN, ...] | None]:
+        raise NotImplementedError()
+
+
+_CODECS: dict[str, type[SnippetCodec]] = dict()
+
+
+def register_codec(codec_class: type[SnippetCodec]) -> type[SnippetCodec]:
+    if codec_class.name in _CODECS:
+        raise ValueError(f"Codec {codec_class.name} is already registered.")
+
+    if any(each_codec.version == codec_class.version for each_codec in _CODECS.values()):
+        raise ValueError(f"Codec version {codec_class.version} is already registered.")
+
+    _CODECS[codec_class.name] = codec_class
+    return codec_class
+
+
+def get_codec_class(name: str) -> type[SnippetCodec]:
+    codec_class = _CODECS.get(name)
+    if codec_class is None:
+        raise KeyError(f"Codec {name} is not registered.")
+    return codec_class
+
+
+def registered_codecs() -> tuple[type[SnippetCodec], ...]:
+    return tuple(_CODECS.values())
+
+
+def record_version(record: bytes) -> int:
+    return record[0]
+
+
+def _pack_string(value: str) -> bytes:
+    encoded = value.encode()
+    return _LENGTH.pack(len(encoded)) + encoded
+
+
+def _unpack_string(payload: bytes, offset: int) -> tuple[str, int]:
+    length, = _LENGTH.unpack_from(payload, offset)
+    offset += _LENGTH.size
+    return payload[offset:offset + length].decode(), offset + length
+
+
+def _pack_column(values: list[int]) -> bytes:
+    # the narrowest type that holds the column, mostly a single byte per value
+    if min(values, default=0) < 0:
+        type_code = "i"
+    else:
+        largest = max(values, default=0)
+        type_code = "B" if largest < 1 << 8 else "H" if largest < 1 << 16 else "I"
+    return type_code.encode() + struct.pack(f"<{len(values)}{type_code}", *values)
+
+
+def _unpack_column(payload: bytes, offset: int, no_values: int) -> tuple[tuple[int, ...], int]:
+    column_format = struct.Struct(f"<{no_values}{chr(payload[offset])}")
+    return column_format.unpack_from(payload, offset + 1), offset + 1 + column_format.size
+
+
+def _pack_tokens(tokens: tuple[TOKEN, ...]) -> bytes:
+    # line deltas, gaps to the previous token and lengths are small and repeat a lot, so they compress well,
+    # each column is decoded by a single struct call and restored by accumulate and map
+    line_numbers = [each_token[0] for each_token in tokens]
+    ends = [end for _, _, end in tokens]
+    columns = (
+        [each_line - each_previous for each_line, each_previous in zip(line_numbers, [0] + line_numbers[:-1])],
+        [start - each_previous for (_, start, _), each_previous in zip(tokens, [0] + ends[:-1])],
+        [end - start for _, start, end in tokens],
+    )
+    return _LENGTH.pack(len(tokens)) + b"".join(_pack_column(each_column) for each_column in columns)
+
+
+def _unpack_tokens(payload: bytes, offset: int) -> tuple[tuple[TOKEN, ...], int]:
+    no_tokens, = _LENGTH.unpack_from(payload, offset)
+    offset += _LENGTH.size
+
+    line_deltas, offset = _unpack_column(payload, offset, no_tokens)
+    gaps, offset = _unpack_column(payload, offset, no_tokens)
+    lengths, offset = _unpack_column(payload, offset, no_tokens)
+
+    # every start follows the end of the previous token, which follows its own start
+    steps = tuple(itertools.accumulate(map(operator.add, gaps, (0,) + lengths[:-1])))
+    ends = map(operator.add, steps, lengths)
+    return tuple(zip(itertools.accumulate(line_deltas), steps, ends)), offset
+
+
+def _pack_fields(text: str, source: str, metadata: dict[str, str | int], tokens: tuple[TOKEN, ...]) -> bytes:
+    parts = [_pack_string(text), _pack_string(source), _LENGTH.pack(len(metadata))]
+    for each_key, each_value in metadata.items():
+        parts.append(_pack_string(each_key))
+        # bools and floats are kept as strings, as they would be by the plain hash layout
+        if isinstance(each_value, int) and not isinstance(each_value, bool):
+            parts.append(bytes((_TYPE_INTEGER,)) + _INTEGER.pack(each_value))
+        else:
+            parts.append(bytes((_TYPE_STRING,)) + _pack_string(str(each_value)))
+    parts.append(_pack_tokens(tokens))
+    return b"".join(parts)
+
+
+def _unpack_fields(payload: bytes, flags: int) -> tuple[str, str, dict[str, str | int], tuple[TOKEN, ...] | None]:
+    text, offset = _unpack_string(payload, 0)
+    source, offset = _unpack_string(payload, offset)
+    no_items, = _LENGTH.unpack_from(payload, offset)
+    offset += _LENGTH.size
+
+    metadata = dict()
+    for _ in range(no_items):
+        each_key, offset = _unpack_string(payload, offset)
+        value_type = payload[offset]
+        offset += 1
+        if value_type == _TYPE_INTEGER:
+            each_value, = _INTEGER.unpack_from(payload, offset)
+            offset += _INTEGER.size
+        else:
+            each_value, offset = _unpack_string(payload, offset)
+        metadata[each_key] = each_value
+
+    # records written before tokenization at ingest carry no tokens
+    tokens = None
+    if flags & _FLAG_TOKENS:
+        tokens, offset = _unpack_tokens(payload, offset)
+
+    return text, source, metadata, tokens
+
+
+@register_codec
+class PackedCodec(SnippetCodec):
+    name = "packed"
+    version = 1
+
+    def encode(
+            self, text: str, source: str, is_bot: bool, metadata: dict[str, str | int],
+            tokens: tuple[TOKEN, ...]) -> bytes:
+        flags = _FLAG_TOKENS | (_FLAG_BOT if is_bot else 0)
+        return _HEADER.pack(self.version, flags, 0) + _pack_fields(text, source, metadata, tokens)
+
+    def decode(self, record: bytes) -> tuple[str, str, bool, dict[str, str | int], tuple[TOKEN, ...] | None]:
+        version, flags, _ = _HEADER.unpack_from(record)
+        if version != self.version:
+            raise ValueError(f"Record version {version} cannot be decoded by {self.name}.")
+
+        text, source, metadata, tokens = _unpack_fields(record[_HEADER.size:], flags)
+        return text, source, bool(flags & _FLAG_BOT), metadata, tokens
+
+
+@register_codec
+class ZlibCodec(SnippetCodec):
+    name = "zlib"
+    version = 2
+
+    @staticmethod
+    def train_dictionary(texts: Iterable[str], max_bytes: int = 32 * 1024) -> bytes:
+        # zlib prefers matches close to the data, so the most valuable fragments go last
+        fragments = Counter()
+        for each_text in texts:
+            words = each_text.split()
+            fragments.update(words)
+            fragments.update(" ".join(each_pair) for each_pair in zip(words, words[1:]))
+
+        ranked = sorted(
+            (each_fragment for each_fragment, count in fragments.items() if 1 < count),
+            key=lambda each_fragment: fragments[each_fragment] * len(each_fragment)
+        )
+
+        selected = list()
+        size = 0
+        for each_fragment in reversed(ranked):
+            encoded = each_fragment.encode() + b" "
+            if max_bytes < size + len(encoded):
+                break
+            selected.append(encoded)
+            size += len(encoded)
+
+        return b"".join(reversed(selected))
+
+    def __init__(self, dictionaries: dict[int, bytes] | None = None, dictionary_id: int = 0, level: int = 6) -> None:
+        super().__init__(dictionaries, dictionary_id)
+        self.level = level
+
+    def encode(
+            self, text: str, source: str, is_bot: bool, metadata: dict[str, str | int],
+            tokens: tuple[TOKEN, ...]) -> bytes:
+        flags = _FLAG_TOKENS | (_FLAG_BOT if is_bot else 0)
+        if 0 < self.dictionary_id:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionaries[self.dictionary_id])
+        else:
+            compressor = zlib.compressobj(self.level)
+
+        payload = compressor.compress(_pack_fields(text, source, metadata, tokens)) + compressor.flush()
+        return _HEADER.pack(self.version, flags, self.dictionary_id) + payload
+
+    def decode(self, record: bytes) -> tuple[str, str, bool, dict[str, str | int], tuple[TOKEN, ...] | None]:
+        version, flags, dictionary_id = _HEADER.unpack_from(record)
+        if version != self.version:
+            raise ValueError(f"Record version {version} cannot be decoded by {self.name}.")
+
+        if 0 < dictionary_id:
+            dictionary = self.dictionaries.get(dictionary_id)
+            if dictionary is None:
+                raise KeyError(f"Dictionary {dictionary_id} is unknown.")
+            decompressor = zlib.decompressobj(zdict=dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+
+        payload = decompressor.decompress(record[_HEADER.size:]) + decompressor.flush()
+        text, source, metadata, tokens = _unpack_fields(payload, flags)
+        return text, source, bool(flags & _FLAG_BOT), metadata, tokens
@@ -0,0 +1,210 @@
+# coding=utf-8
+import dataclasses
+import hashlib
+import random
+import re
+import struct
+import zlib
+from typing import Callable, Sequence
+
+from redis import Redis
+from redis.client import Pipeline
+from redis.commands.core import Script
+
+from src.dataobjects import Snippet
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+_NO_BANDS = 16
+_ROWS_PER_BAND = 4
+_NO_PERMUTATIONS = _NO_BANDS * _ROWS_PER_BAND
+
+# the permutations must be the same in every process, otherwise stored signatures cannot be compared
+_random = random.Random(0)
+_PERMUTATIONS = tuple(
+    (_random.randrange(1, _MERSENNE_PRIME), _random.randrange(0, _MERSENNE_PRIME))
+    for _ in range(_NO_PERMUTATIONS)
+)
+
+# minimum values are truncated to 16 bit, that keeps a band at 8 bytes and barely biases the estimate
+_SIGNATURE = struct.Struct(f">{_NO_PERMUTATIONS}H")
+# buckets hold the packed ids of all their snippets, usually just one
+_ID = struct.Struct(">I")
+
+FINGERPRINT = tuple[bytes, tuple[int, ...] | None]
+
+
+@dataclasses.dataclass(frozen=True)
+class RejectedSnippet:
+    snippet: Snippet
+    duplicate_of: int
+    similarity: float
+
+
+class SnippetDeduplicator:
+    @staticmethod
+    def fingerprint(text: str) -> FINGERPRINT:
+        words = re.findall(r"\w+", text.lower())
+        digest = hashlib.blake2b(" ".join(words).encode(), digest_size=8).digest()
+        if len(words) < 1:
+            return digest, None
+
+        shingles = {" ".join(each_pair) for each_pair in zip(words, words[1:])} or {words[0]}
+        hashes = [zlib.crc32(each_shingle.encode()) for each_shingle in shingles]
+        signature = tuple(
+            min([(a * each_hash + b) % _MERSENNE_PRIME for each_hash in hashes]) & 0xFFFF
+            for a, b in _PERMUTATIONS
+        )
+        return digest, signature
+
+    @staticmethod
+    def similarity(signature: Sequence[int], other: Sequence[int]) -> float:
+        return sum(a == b for a, b in zip(signature, other)) / _NO_PERMUTATIONS
+
+    @staticmethod
+    def _bands(signature: tuple[int, ...]) -> list[bytes]:
+        packed = _SIGNATURE.pack(*signature)
+        band_size = 2 * _ROWS_PER_BAND
+        return [packed[i * band_size:(i + 1) * band_size] for i in range(_NO_BANDS)]
+
+    @staticmethod
+    def _unpack_ids(packed: bytes | None) -> set[int]:
+        if packed is None:
+            return set()
+        return {each_id for each_id, in _ID.iter_unpack(packed)}
+
+    def __init__(
+            self, redis: Redis, get_texts: Callable[[list[int]], list[str | None]], threshold: float = .8) -> None:
+        # banding finds pairs above a similarity of about .5, the threshold is applied to the full signatures
+        if not 0. < threshold <= 1.:
+            raise ValueError("Similarity threshold must be between 0 and 1.")
+
+        self.redis = redis
+        # signatures are not stored, the few candidates of a bucket are fingerprinted again from their texts
+        self.get_texts = get_texts
+        self.threshold = threshold
+
+        self._add_to_buckets = self.redis.register_script(
+            "for i, bucket_key in ipairs(KEYS) do "
+            "  local ids = redis.call('HGET', bucket_key, ARGV[i + 1]) or '' "
+            "  redis.call('HSET', bucket_key, ARGV[i + 1], ids .. ARGV[1]) "
+            "end"
+        )
+
+        self._remove_from_buckets = self.redis.register_script(
+            "for i, bucket_key in ipairs(KEYS) do "
+            "  local ids = redis.call('HGET', bucket_key, ARGV[i + 1]) "
+            "  if ids then "
+            "    local kept = {} "
+            "    for j = 1, #ids, 4 do "
+            "      local each_id = string.sub(ids, j, j + 3) "
+            "      if each_id ~= ARGV[1] then table.insert(kept, each_id) end "
+            "    end "
+            "    if #kept < 1 then "
+            "      redis.call('HDEL', bucket_key, ARGV[i + 1]) "
+            "    else "
+            "      redis.call('HSET', bucket_key, ARGV[i + 1], table.concat(kept)) "
+            "    end "
+            "  end "
+            "end"
+        )
+
+    def _signatures(self, snippet_ids: set[int]) -> dict[int, tuple[int, ...]]:
+        if len(snippet_ids) < 1:
+            return dict()
+
+        candidate_ids = sorted(snippet_ids)
+        signatures = dict()
+        for snippet_id, each_text in zip(candidate_ids, self.get_texts(candidate_ids)):
+            # snippets removed in the meantime have no text anymore
+            if each_text is None:
+                continue
+            _, each_signature = SnippetDeduplicator.fingerprint(each_text)
+            if each_signature is not None:
+                signatures[snippet_id] = each_signature
+        return signatures
+
+    def find_duplicates(
+            self, fingerprints: Sequence[FINGERPRINT]) -> list[tuple[int | None, int | None, float] | None]:
+        # each match is either a stored snippet id or the index of an earlier fingerprint in the same batch
+        with self.redis.pipeline(transaction=False) as pipe:
+            for digest, signature in fingerprints:
+                pipe.hget("snippet_exact", digest)
+                if signature is not None:
+                    for i, each_band in enumerate(SnippetDeduplicator._bands(signature)):
+                        pipe.hget(f"snippet_lsh:{i}", each_band)
+            results = iter(pipe.execute())
+
+        candidates = list()
+        for digest, signature in fingerprints:
+            exact_id = next(results)
+            band_ids = set()
+            if signature is not None:
+                for _ in range(_NO_BANDS):
+                    band_ids.update(SnippetDeduplicator._unpack_ids(next(results)))
+            candidates.append((None if exact_id is None else int(exact_id), band_ids))
+
+        signatures = self._signatures(set().union(*(
+            each_ids for exact_id, each_ids in candidates if exact_id is None
+        )))
+
+        duplicates = list()
+        batch_exact = dict()
+        batch_bands = dict()
+        for index, ((digest, signature), (exact_id, band_ids)) in enumerate(zip(fingerprints, candidates)):
+            duplicate = None
+            if exact_id is not None:
+                duplicate = exact_id, None, 1.
+            elif digest in batch_exact:
+                duplicate = None, batch_exact[digest], 1.
+            elif signature is not None:
+                bands = SnippetDeduplicator._bands(signature)
+                best_similarity = 0.
+                for each_id in band_ids:
+                    each_signature = signatures.get(each_id)
+                    if each_signature is None:
+                        continue
+                    each_similarity = SnippetDeduplicator.similarity(signature, each_signature)
+                    if best_similarity < each_similarity:
+                        best_similarity = each_similarity
+                        duplicate = each_id, None, each_similarity
+
+                batch_indices = set().union(*(
+                    batch_bands.get((i, each_band), ()) for i, each_band in enumerate(bands)
+                ))
+                for each_index in batch_indices:
+                    each_similarity = SnippetDeduplicator.similarity(signature, fingerprints[each_index][1])
+                    if best_similarity < each_similarity:
+                        best_similarity = each_similarity
+                        duplicate = None, each_index, each_similarity
+
+                if best_similarity < self.threshold:
+                    duplicate = None
+
+            duplicates.append(duplicate)
+            if duplicate is None:
+                batch_exact[digest] = index
+                if signature is not None:
+                    for i, each_band in enumerate(SnippetDeduplicator._bands(signature)):
+                        batch_bands.setdefault((i, each_band), list()).append(index)
+
+        return duplicates
+
+    def _bucket_call(self, script: Script, pipe: Pipeline, snippet_id: int, signature: tuple[int, ...]) -> None:
+        keys = [f"snippet_lsh:{i}" for i in range(_NO_BANDS)]
+        script(keys=keys, args=[_ID.pack(snippet_id), *SnippetDeduplicator._bands(signature)], client=pipe)
+
+    def add(self, pipe: Pipeline, snippet_id: int, fingerprint: FINGERPRINT) -> None:
+        digest, signature = fingerprint
+        pipe.hset("snippet_exact", digest, snippet_id)
+        if signature is not None:
+            self._bucket_call(self._add_to_buckets, pipe, snippet_id, signature)
+
+    def remove(self, pipe: Pipeline, snippet_id: int, fingerprint: FINGERPRINT) -> None:
+        digest, signature = fingerprint
+        pipe.hdel("snippet_exact", digest)
+        if signature is not None:
+            self._bucket_call(self._remove_from_buckets, pipe, snippet_id, signature)
+
+    def clear(self) -> None:
+        self.redis.delete("snippet_exact", *(f"snippet_lsh:{i}" for i in range(_NO_BANDS)))
@@ -1,61 +1,669 @@
 # coding=utf-8
+import dataclasses
+import functools
 import json
 import random
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Generator
 
 from loguru import logger
 from redis import Redis
+from redis.client import Pipeline
 
-from src.dataobjects import Snippet, User
+from src.database.snippet_cache import SnippetCache
+from src.database.snippet_deduplicator import SnippetDeduplicator, RejectedSnippet
+from src.database.snippet_codec import SnippetCodec, ZlibCodec, get_codec_class, record_version, registered_codecs
+from src.database.snippet_prefetcher import SnippetPrefetcher
+from src.dataobjects import Snippet, SnippetDeck, User, TOKEN, tokenize
+
+
+def _batched(items: Iterable, batch_size: int) -> Generator[tuple, None, None]:
+    iterator = iter(items)
+    while each_batch := tuple(islice(iterator, batch_size)):
+        yield each_batch
+
+
+def _permute(index: int, size: int, seed: int) -> int:
+    # four round feistel network over the smallest even bit width covering `size`, cycle walking back into range
+    half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+    half_mask = (1 << half_bits) - 1
+
+    value = index
+    while True:
+        left, right = value >> half_bits, value & half_mask
+        for each_round in range(4):
+            round_key = (seed * 0x9E3779B1 + each_round * 0x85EBCA6B) & 0xFFFFFFFF
+            mixed = ((right ^ round_key) * 0x45D9F3B) & 0xFFFFFFFF
+            mixed ^= mixed >> 16
+            left, right = right, (left ^ mixed) & half_mask
+
+        value = (left << half_bits) | right
+        if value < size:
+            return value
 
 
 class SnippetManager:
-    def __init__(self, redis_conf: dict[str, str]):
+    def __init__(
+            self, redis_conf: dict[str, str],
+            prefetch_depth: int = 3, cache_bytes: int = 16 * 1024 * 1024, codec: str = "zlib",
+            bot_ratio: float | None = None, deck_expiration_seconds: int = 60 * 60,
+            duplicate_threshold: float | None = .8, progress_expiration_seconds: int = 60 * 60 * 24 * 7 * 4 * 6,
+            prefetch_workers: int = 8):
         self.redis = Redis(**redis_conf)
         logger.info("Snippets initialized.")
 
-        if self.redis.exists("snippet_id_counter"):
-            self.snippet_count = int(self.redis.get("snippet_id_counter"))
+        # share of bot snippets served, None draws from all snippets regardless of their class
+        if bot_ratio is not None and not 0. <= bot_ratio <= 1.:
+            raise ValueError("Bot ratio must be between 0 and 1.")
+        self.bot_ratio = bot_ratio
+
+        # intersections for decks with several filters are kept this long, new snippets join them afterwards
+        self.deck_expiration_seconds = deck_expiration_seconds
+        # every draw refreshes the expiration of the user's progress, like every update does for the user
+        self.progress_expiration_seconds = progress_expiration_seconds
+
+        # near-duplicates of stored snippets are rejected at ingest, None stores everything
+        self.deduplicator = None if duplicate_threshold is None else SnippetDeduplicator(
+            self.redis, self._get_texts, threshold=duplicate_threshold
+        )
+
+        # "plain" keeps the readable hash layout, any registered codec packs the snippet into a single record field
+        self.codec_name = codec
+        self.codec: SnippetCodec | None = None
+        self._codecs: dict[int, SnippetCodec] = dict()
+        self._load_codecs()
+
+        # snippets are immutable once written, so decoded instances can be kept until removal
+        self.cache = SnippetCache(max_bytes=cache_bytes)
+
+        self.prefetch_depth = prefetch_depth
+        # shared by the prefetchers of all users, it bounds the concurrent draws against the database
+        self._prefetch_executor = ThreadPoolExecutor(
+            max_workers=prefetch_workers, thread_name_prefix="snippet_prefetch"
+        )
+        self._prefetchers: weakref.WeakSet[SnippetPrefetcher] = weakref.WeakSet()
+
+        # the counter is created by the first INCR, a missing counter means no snippets yet
+        self.snippet_count = int(self.redis.get("snippet_id_counter") or 0)
+
+        # mirror of the `snippet_live` bitmap, refreshed whenever a deck is shuffled
+        self._live = bytearray()
+        self._refresh_live()
+
+    def _refresh_live(self) -> None:
+        self._live = bytearray(self.redis.get("snippet_live") or b"")
+        for each_id in self.cache.snippet_ids():
+            if not self._is_live(each_id):
+                self.cache.invalidate(each_id)
+
+    def _is_live(self, snippet_id: int) -> bool:
+        byte_index = snippet_id >> 3
+        if byte_index >= len(self._live):
+            # written after the last refresh, the storage decides
+            return True
+        return bool(self._live[byte_index] & (0x80 >> (snippet_id & 7)))
+
+    def _set_live(self, snippet_id: int, live: bool) -> None:
+        # same bit order as redis SETBIT
+        byte_index = snippet_id >> 3
+        if byte_index >= len(self._live):
+            if not live:
+                return
+            self._live.extend(bytes(byte_index + 1 - len(self._live)))
+
+        if live:
+            self._live[byte_index] |= 0x80 >> (snippet_id & 7)
         else:
-            self.snippet_count = 0
-            self.redis.set("snippet_id_counter", self.snippet_count)
+            self._live[byte_index] &= ~(0x80 >> (snippet_id & 7)) & 0xFF
 
-    def set_snippet(self, text: str, source: str, is_bot: bool, metadata: dict[str, str]) -> str:
-        # Store the snippet and its hash
-        snippet_key = f"snippet:{self.snippet_count}"
-        self.redis.hset(snippet_key, mapping={
+    def _load_codecs(self) -> None:
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall("snippet_dictionaries")
+            pipe.get("snippet_dictionary_id")
+            stored_dictionaries, dictionary_id = pipe.execute()
+
+        dictionaries = {int(key): value for key, value in stored_dictionaries.items()}
+        dictionary_id = int(dictionary_id or 0)
+
+        self._codecs = {
+            each_class.version: each_class(dictionaries=dictionaries, dictionary_id=dictionary_id)
+            for each_class in registered_codecs()
+        }
+        self.codec = self._get_codec(self.codec_name)
+
+    def _get_codec(self, name: str) -> SnippetCodec | None:
+        if name == "plain":
+            return None
+        return self._codecs[get_codec_class(name).version]
+
+    @staticmethod
+    def _snippet_mapping(
+            codec: SnippetCodec | None,
+            text: str, source: str, is_bot: bool, metadata: dict[str, str],
+            tokens: tuple[TOKEN, ...]) -> dict[str, str | bytes]:
+
+        if codec is not None:
+            return {"record": codec.encode(text, source, is_bot, metadata, tokens)}
+
+        return {
             "text": text,
             "source": source,
             "is_bot": str(int(is_bot)),
-            "metadata": json.dumps(metadata)
-        })
+            "metadata": json.dumps(metadata),
+            "tokens": json.dumps(tokens)
+        }
+
+    def _decode_fields(
+            self, result: dict[bytes, bytes]) -> tuple[str, str, bool, dict[str, str | int], tuple[TOKEN, ...]]:
+
+        record = result.get(b"record")
+        if record is None:
+            data = {
+                key.decode(): value.decode()
+                for key, value in result.items()
+            }
+            metadata = json.loads(data.pop("metadata"))
+            tokens_json = data.pop("tokens", None)
+            tokens = None if tokens_json is None else tuple(tuple(each_token) for each_token in json.loads(tokens_json))
+            text, source, is_bot = data.pop("text"), data.pop("source"), bool(int(data.pop("is_bot")))
+
+        else:
+            codec = self._codecs.get(record_version(record))
+            if codec is None:
+                raise ValueError(f"No codec for record version {record_version(record)}.")
+
+            try:
+                text, source, is_bot, metadata, tokens = codec.decode(record)
 
-        self.snippet_count = int(self.redis.incr("snippet_id_counter"))
-        return snippet_key
+            except KeyError:
+                # the record refers to a dictionary trained by another process after this one started
+                self._load_codecs()
+                text, source, is_bot, metadata, tokens = self._codecs[record_version(record)].decode(record)
+
+        if tokens is None:
+            # snippets stored before tokenization at ingest
+            tokens = tokenize(text)
+
+        return text, source, is_bot, metadata, tokens
+
+    @staticmethod
+    def _update_metadata_indexes(
+            pipe: Pipeline, snippet_id: int, text: str, is_bot: bool, metadata: dict[str, str | int], add: bool) -> None:
+
+        class_name = "bot" if is_bot else "human"
+        scores = {
+            f"snippet_index:class:{class_name}": snippet_id,
+            "snippet_index:length": len(text),
+        }
+
+        channel = metadata.get("channel")
+        if channel is not None:
+            scores[f"snippet_index:channel:{channel}"] = snippet_id
+
+        try:
+            scores["snippet_index:likes"] = int(metadata["likes"])
+        except (KeyError, TypeError, ValueError):
+            pass
+
+        for each_key, each_score in scores.items():
+            if add:
+                pipe.zadd(each_key, {snippet_id: each_score})
+            else:
+                pipe.zrem(each_key, snippet_id)
+
+    def set_snippet(self, text: str, source: str, is_bot: bool, metadata: dict[str, str]) -> str:
+        rejected = list()
+        snippet_ids = self.set_snippets([Snippet(text, source, is_bot, tuple(metadata.items()))], rejected=rejected)
+        if 0 < len(rejected):
+            raise ValueError(f"Snippet duplicates snippet {rejected[0].duplicate_of}.")
+        snippet_id, = snippet_ids
+        return f"snippet:{snippet_id}"
+
+    def set_snippets(
+            self, snippets: Iterable[Snippet], batch_size: int = 1_000,
+            rejected: list[RejectedSnippet] | None = None) -> list[int]:
+
+        if 0 >= batch_size:
+            raise ValueError("Batch size must be positive.")
+
+        snippet_ids = list()
+        for each_batch in _batched(snippets, batch_size):
+            fingerprints = None
+            duplicates = [None] * len(each_batch)
+            if self.deduplicator is not None:
+                fingerprints = [SnippetDeduplicator.fingerprint(each_snippet.text) for each_snippet in each_batch]
+                duplicates = self.deduplicator.find_duplicates(fingerprints)
+
+            kept_indices = [i for i, each_duplicate in enumerate(duplicates) if each_duplicate is None]
+            batch_snippets = each_batch
+            each_batch = tuple(batch_snippets[i] for i in kept_indices)
+            no_snippets = len(each_batch)
+
+            # reserve a contiguous id block for the whole batch, so that concurrent writers never share a key
+            to_snippet_id = self.redis.incrby("snippet_id_counter", no_snippets)
+            from_snippet_id = to_snippet_id - no_snippets
+
+            with self.redis.pipeline(transaction=False) as pipe:
+                for snippet_id, each_index, each_snippet in zip(
+                        range(from_snippet_id, to_snippet_id), kept_indices, each_batch):
+                    if fingerprints is not None:
+                        self.deduplicator.add(pipe, snippet_id, fingerprints[each_index])
+                    tokens = each_snippet.tokens or tokenize(each_snippet.text)
+                    mapping = self._snippet_mapping(
+                        self.codec,
+                        each_snippet.text, each_snippet.source, each_snippet.is_bot, dict(each_snippet.metadata),
+                        tokens
+                    )
+                    pipe.hset(f"snippet:{snippet_id}", mapping=mapping)
+                    pipe.setbit("snippet_live", snippet_id, 1)
+                    self._update_metadata_indexes(
+                        pipe, snippet_id, each_snippet.text, each_snippet.is_bot, dict(each_snippet.metadata), True
+                    )
+
+                pipe.execute()
+
+            for snippet_id in range(from_snippet_id, to_snippet_id):
+                self._set_live(snippet_id, True)
+            snippet_ids.extend(range(from_snippet_id, to_snippet_id))
+            self.snippet_count = max(self.snippet_count, to_snippet_id)
+            if 0 < no_snippets:
+                logger.info(f"Stored snippets {from_snippet_id} to {to_snippet_id - 1}.")
+
+            # duplicates within the batch refer to a snippet that has just been stored
+            batch_ids = dict(zip(kept_indices, range(from_snippet_id, to_snippet_id)))
+            rejections = list()
+            for each_snippet, each_duplicate in zip(batch_snippets, duplicates):
+                if each_duplicate is not None:
+                    snippet_id, batch_index, similarity = each_duplicate
+                    duplicate_of = batch_ids[batch_index] if snippet_id is None else snippet_id
+                    rejections.append(RejectedSnippet(each_snippet, duplicate_of, similarity))
+
+            if 0 < len(rejections):
+                logger.info(f"Rejected {len(rejections)} of {len(batch_snippets)} snippets as duplicates.")
+                if rejected is not None:
+                    rejected.extend(rejections)
+
+        return snippet_ids
+
+    def _get_texts(self, snippet_ids: list[int]) -> list[str | None]:
+        with self.redis.pipeline(transaction=False) as pipe:
+            for each_id in snippet_ids:
+                pipe.hgetall(f"snippet:{each_id}")
+            results = pipe.execute()
+        return [None if len(each_result) < 1 else self._decode_fields(each_result)[0] for each_result in results]
 
     def get_snippet(self, snippet_id: int) -> Snippet:
+        snippet = self.cache.get(snippet_id)
+        if snippet is not None:
+            return snippet
+
         snippet_key = f"snippet:{snippet_id}"
-        if not self.redis.exists(snippet_key):
+        result = self.redis.hgetall(snippet_key)
+        if len(result) < 1:
             raise KeyError(f"Snippet {snippet_id} does not exist.")
 
-        result = self.redis.hgetall(snippet_key)
-        data = {
-            key.decode(): value.decode()
-            for key, value in result.items()
-        }
+        text, source, is_bot, metadata, tokens = self._decode_fields(result)
+        snippet = Snippet(text, source, is_bot, metadata, tokens=tokens, db_id=snippet_id)
+        self.cache.put(snippet_id, snippet)
+        return snippet
 
-        metadata = json.loads(data.pop("metadata"))
-        return Snippet(data.pop("text"), data.pop("source"), bool(int(data.pop("is_bot"))), metadata, db_id=snippet_id)
+    def train_dictionary(self, sample_size: int = 1_000, max_bytes: int = 32 * 1024) -> int:
+        snippet_count = int(self.redis.get("snippet_id_counter") or 0)
+        sample_ids = random.sample(range(snippet_count), min(sample_size, snippet_count))
+
+        with self.redis.pipeline(transaction=False) as pipe:
+            for each_id in sample_ids:
+                pipe.hgetall(f"snippet:{each_id}")
+            results = pipe.execute()
+
+        texts = tuple(self._decode_fields(each_result)[0] for each_result in results if 0 < len(each_result))
+        dictionary = ZlibCodec.train_dictionary(texts, max_bytes=max_bytes)
+
+        dictionary_id = int(self.redis.incr("snippet_dictionary_counter"))
+        with self.redis.pipeline() as pipe:
+            pipe.hset("snippet_dictionaries", str(dictionary_id), dictionary)
+            pipe.set("snippet_dictionary_id", dictionary_id)
+            pipe.execute()
+
+        self._load_codecs()
+        logger.info(f"Trained dictionary {dictionary_id} with {len(dictionary)} bytes on {len(texts)} snippets.")
+        return dictionary_id
+
+    def migrate_snippets(self, codec: str, batch_size: int = 1_000) -> int:
+        target_codec = self._get_codec(codec)
+        migrated = 0
+
+        for each_batch in _batched(self._stored_snippets(batch_size), batch_size):
+            with self.redis.pipeline() as pipe:
+                for snippet_id, each_result in each_batch:
+                    mapping = self._snippet_mapping(target_codec, *self._decode_fields(each_result))
+                    pipe.delete(f"snippet:{snippet_id}")
+                    pipe.hset(f"snippet:{snippet_id}", mapping=mapping)
+                    migrated += 1
+                pipe.execute()
+
+            logger.info(f"Migrated {migrated} snippets to {codec}.")
+
+        self.cache.clear()
+        return migrated
+
+    def _next_snippet_id(self, user: User) -> tuple[int, int]:
+        # deck over all snippets written so far, reshuffled once exhausted
+        drawn = self._next_deck_position(
+            user, "all", lambda: (0, int(self.redis.get("snippet_id_counter") or 0))
+        )
+        if drawn is None:
+            raise ValueError("No snippets available.")
+        return drawn
+
+    def _next_deck_position(
+            self, user: User, deck_name: str, get_bounds: Callable[[], tuple[int, int]]) -> tuple[int, int] | None:
+
+        progress_key = f"user:{user.db_id}:progress"
+        with self.redis.pipeline() as pipe:
+            pipe.hincrby(progress_key, f"{deck_name}_index", 1)
+            pipe.hmget(progress_key, f"{deck_name}_seed", f"{deck_name}_size", f"{deck_name}_offset")
+            # consumption is counted along with the draw, the replenishment worker watches it
+            pipe.incr("snippet_stats:drawn")
+            # the user expires in the users database, its cursors follow
+            pipe.expire(progress_key, self.progress_expiration_seconds)
+            next_index, (seed, deck_size, offset), *_ = pipe.execute()
+
+        index = next_index - 1
+        if seed is None or int(deck_size) <= index:
+            self._refresh_live()
+            offset, deck_size = get_bounds()
+            if 0 >= deck_size:
+                return None
+
+            seed = random.getrandbits(32)
+            self.redis.hset(progress_key, mapping={
+                f"{deck_name}_seed": seed,
+                f"{deck_name}_size": deck_size,
+                f"{deck_name}_offset": offset,
+                f"{deck_name}_index": 1
+            })
+            index = 0
+
+        deck_size = int(deck_size)
+        return int(offset or 0) + _permute(index, deck_size, int(seed)), deck_size
+
+    def _next_class_snippet_id(self, user: User, is_bot: bool) -> tuple[int | None, int] | None:
+        class_name = "bot" if is_bot else "human"
+        class_key = f"snippet_index:class:{class_name}"
+        drawn = self._next_deck_position(user, class_name, lambda: (0, self.redis.zcard(class_key)))
+        if drawn is None:
+            return None
+
+        # the class index is ordered by id, removals shift the ranks and the end of the deck is drawn as a hole
+        rank, deck_size = drawn
+        snippet_ids = self.redis.zrange(class_key, rank, rank)
+        return (int(snippet_ids[0]) if 0 < len(snippet_ids) else None), deck_size
+
+    def _deck_source(self, deck: SnippetDeck) -> tuple[str, float | str, float | str]:
+        # sorted set the deck is drawn from by rank, with the score range that matches the deck
+        id_sets = list()
+        if deck.channel is not None:
+            id_sets.append(f"snippet_index:channel:{deck.channel}")
+        if deck.is_bot is not None:
+            id_sets.append(f"snippet_index:class:{'bot' if deck.is_bot else 'human'}")
+
+        score_ranges = list()
+        if deck.min_likes is not None or deck.max_likes is not None:
+            score_ranges.append((
+                "snippet_index:likes",
+                "-inf" if deck.min_likes is None else deck.min_likes,
+                "+inf" if deck.max_likes is None else deck.max_likes
+            ))
+        if deck.min_length is not None or deck.max_length is not None:
+            score_ranges.append((
+                "snippet_index:length",
+                "-inf" if deck.min_length is None else deck.min_length,
+                "+inf" if deck.max_length is None else deck.max_length
+            ))
+
+        if len(id_sets) == 1 and len(score_ranges) < 1:
+            return id_sets[0], "-inf", "+inf"
+
+        if len(id_sets) < 1 and len(score_ranges) == 1:
+            return score_ranges[0]
+
+        # combined filters are intersected once per deck and shared by all users drawing from the same deck
+        deck_key = f"snippet_deck:{deck.deck_id}"
+        if not self.redis.exists(deck_key):
+            temporary_keys = list()
+            with self.redis.pipeline() as pipe:
+                for i, (each_key, score_min, score_max) in enumerate(score_ranges):
+                    temporary_key = f"{deck_key}:range:{i}"
+                    pipe.zrangestore(temporary_key, each_key, score_min, score_max, byscore=True)
+                    temporary_keys.append(temporary_key)
+
+                weights = {each_key: 1 for each_key in id_sets}
+                weights.update({each_key: 0 for each_key in temporary_keys})
+                pipe.zinterstore(deck_key, weights)
+                pipe.expire(deck_key, self.deck_expiration_seconds)
+                if 0 < len(temporary_keys):
+                    pipe.delete(*temporary_keys)
+                pipe.execute()
+
+        return deck_key, "-inf", "+inf"
+
+    def _deck_bounds(self, deck: SnippetDeck) -> tuple[int, int]:
+        source_key, score_min, score_max = self._deck_source(deck)
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zcount(source_key, "-inf", f"({score_min}")
+            pipe.zcount(source_key, score_min, score_max)
+            offset, deck_size = pipe.execute()
+        return (0 if score_min == "-inf" else offset), deck_size
+
+    def _next_deck_snippet_id(self, user: User, deck: SnippetDeck) -> tuple[int | None, int] | None:
+        drawn = self._next_deck_position(user, f"deck:{deck.deck_id}", lambda: self._deck_bounds(deck))
+        if drawn is None:
+            return None
+
+        rank, deck_size = drawn
+        source_key, score_min, score_max = self._deck_source(deck)
+        result = self.redis.zrange(source_key, rank, rank, withscores=True)
+        if len(result) < 1:
+            return None, deck_size
+
+        # ranks shift when snippets are added below the deck, those draws are treated like holes
+        (member, score), = result
+        if score_min != "-inf" and score < float(score_min) or score_max != "+inf" and float(score_max) < score:
+            return None, deck_size
+
+        return int(member), deck_size
+
+    def _draw_snippet_id(self, user: User, deck: SnippetDeck | None) -> tuple[int | None, int]:
+        if deck is not None and deck != SnippetDeck():
+            decks = [deck]
+            if self.bot_ratio is not None and deck.is_bot is None:
+                is_bot = random.random() < self.bot_ratio
+                decks = [dataclasses.replace(deck, is_bot=is_bot), dataclasses.replace(deck, is_bot=not is_bot)]
+
+            for each_deck in decks:
+                drawn = self._next_deck_snippet_id(user, each_deck)
+                if drawn is not None:
+                    return drawn
+
+            raise KeyError(f"No snippets in deck {deck}.")
+
+        if self.bot_ratio is not None:
+            # each class is walked in its own permutation, so the class is chosen first and no draw is rejected
+            is_bot = random.random() < self.bot_ratio
+            drawn = self._next_class_snippet_id(user, is_bot)
+            if drawn is None:
+                drawn = self._next_class_snippet_id(user, not is_bot)
+            if drawn is not None:
+                return drawn
+
+        return self._next_snippet_id(user)
+
+    def get_next_snippet(self, user: User, deck: SnippetDeck | None = None) -> Snippet:
+        attempts = 0
+        while True:
+            snippet_id, deck_size = self._draw_snippet_id(user, deck)
+            # removed snippets leave holes in the deck, the live mirror skips them without fetching
+            if snippet_id is not None and self._is_live(snippet_id):
+                try:
+                    snippet = self.get_snippet(snippet_id)
+                    break
+
+                except KeyError:
+                    # removed by another process since the last refresh
+                    self._set_live(snippet_id, False)
+
+            attempts += 1
+            if deck_size < attempts:
+                raise KeyError("No snippets left in deck.")
 
-    def get_next_snippet(self, user: User) -> Snippet:
-        recent_snippet_ids = user.recent_snippet_ids
-        while (random_snippet_id := random.randint(0, self.snippet_count - 1)) in recent_snippet_ids:
-            pass
-        recent_snippet_ids.append(random_snippet_id)
-        snippet = self.get_snippet(random_snippet_id)
         return snippet
 
+    def _stored_snippets(self, batch_size: int) -> Generator[tuple[int, dict[bytes, bytes]], None, None]:
+        snippet_keys = (
+            each_key for each_key in self.redis.scan_iter(match="snippet:*", count=batch_size)
+            if each_key.decode().removeprefix("snippet:").isdigit()
+        )
+        for each_batch in _batched(snippet_keys, batch_size):
+            with self.redis.pipeline(transaction=False) as pipe:
+                for each_key in each_batch:
+                    pipe.hgetall(each_key)
+                results = pipe.execute()
+
+            for each_key, each_result in zip(each_batch, results):
+                if 0 < len(each_result):
+                    yield int(each_key.decode().removeprefix("snippet:")), each_result
+
+    def rebuild_indexes(self, batch_size: int = 1_000) -> tuple[int, int]:
+        no_snippets = {True: 0, False: 0}
+        self.redis.delete("snippet_live")
+
+        for each_pattern in ("snippet_index:*", "snippet_deck:*"):
+            for each_batch in _batched(self.redis.scan_iter(match=each_pattern, count=batch_size), batch_size):
+                self.redis.delete(*each_batch)
+
+        if self.deduplicator is not None:
+            self.deduplicator.clear()
+
+        for each_batch in _batched(self._stored_snippets(batch_size), batch_size):
+            with self.redis.pipeline(transaction=False) as pipe:
+                for snippet_id, each_result in each_batch:
+                    text, _, is_bot, metadata, _ = self._decode_fields(each_result)
+                    self._update_metadata_indexes(pipe, snippet_id, text, is_bot, metadata, True)
+                    if self.deduplicator is not None:
+                        self.deduplicator.add(pipe, snippet_id, SnippetDeduplicator.fingerprint(text))
+                    pipe.setbit("snippet_live", snippet_id, 1)
+                    no_snippets[is_bot] += 1
+                pipe.execute()
+
+        self._refresh_live()
+        logger.info(f"Indexed {no_snippets[True]} bot and {no_snippets[False]} human snippets.")
+        return no_snippets[True], no_snippets[False]
+
+    def compact_snippets(self, max_hole_ratio: float = .1, batch_size: int = 1_000) -> int:
+        # renumbers snippets into a dense id range, must not run while snippets are ingested
+        self._refresh_live()
+        snippet_count = int(self.redis.get("snippet_id_counter") or 0)
+        live_ids = [each_id for each_id in range(snippet_count) if self._is_live(each_id)]
+        no_holes = snippet_count - len(live_ids)
+        if no_holes <= max_hole_ratio * snippet_count:
+            logger.info(f"{no_holes} holes in {snippet_count} snippet ids, no compaction necessary.")
+            return 0
+
+        no_live = len(live_ids)
+        moving_ids = [each_id for each_id in live_ids if each_id >= no_live]
+        free_ids = [each_id for each_id in range(no_live) if not self._is_live(each_id)]
+
+        for each_batch in _batched(zip(moving_ids, free_ids), batch_size):
+            with self.redis.pipeline() as pipe:
+                for from_snippet_id, to_snippet_id in each_batch:
+                    pipe.rename(f"snippet:{from_snippet_id}", f"snippet:{to_snippet_id}")
+                pipe.execute()
+
+        self.redis.set("snippet_id_counter", no_live)
+        self.snippet_count = no_live
+
+        # rebuilds the live bitmap for the dense range as well
+        self.rebuild_indexes(batch_size=batch_size)
+
+        # decks refer to the old ids
+        prefetchers = list(self._prefetchers)
+        for each_prefetcher in prefetchers:
+            each_prefetcher.clear(requeue=False, refill=False)
+
+        progress_keys = self.redis.scan_iter(match="user:*:progress", count=batch_size)
+        for each_batch in _batched(progress_keys, batch_size):
+            self.redis.delete(*each_batch)
+
+        self.cache.clear()
+        for each_prefetcher in prefetchers:
+            each_prefetcher.fill()
+
+        logger.info(f"Moved {len(moving_ids)} snippets to close {no_holes} holes.")
+        return len(moving_ids)
+
+    def get_statistics(self) -> dict[str, int]:
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.get("snippet_stats:drawn")
+            pipe.zcard("snippet_index:class:bot")
+            pipe.zcard("snippet_index:class:human")
+            drawn, bots, humans = pipe.execute()
+        return {"drawn": int(drawn or 0), "bots": bots, "humans": humans}
+
+    def get_random_snippet_ids(self, count: int, is_bot: bool | None = None) -> list[int]:
+        # the indexes only hold live snippets, so every sample is a stored snippet and no hole is stepped over
+        if is_bot is None:
+            index_key = "snippet_index:length"
+        else:
+            index_key = f"snippet_index:class:{'bot' if is_bot else 'human'}"
+        return [int(each_id) for each_id in self.redis.zrandmember(index_key, count)]
+
+    def create_prefetcher(self, user: User, deck: SnippetDeck | None = None) -> SnippetPrefetcher:
+        get_next_snippet = functools.partial(self.get_next_snippet, deck=deck)
+        prefetcher = SnippetPrefetcher(get_next_snippet, user, self._prefetch_executor, depth=self.prefetch_depth)
+        self._prefetchers.add(prefetcher)
+        prefetcher.clear()
+        return prefetcher
+
+    def reset_deck(self, user: User) -> None:
+        # running draws finish before the progress goes, otherwise they would write it back
+        prefetchers = [
+            each_prefetcher for each_prefetcher in list(self._prefetchers)
+            if each_prefetcher.user.db_id == user.db_id
+        ]
+        for each_prefetcher in prefetchers:
+            each_prefetcher.clear(refill=False)
+
+        self.redis.delete(f"user:{user.db_id}:progress")
+        for each_prefetcher in prefetchers:
+            each_prefetcher.fill()
+
+    def change_deck(self, prefetcher: SnippetPrefetcher, deck: SnippetDeck | None) -> None:
+        # snippets drawn from the previous deck or filter are not shown anymore
+        prefetcher.clear(requeue=False, refill=False)
+        prefetcher.set_source(functools.partial(self.get_next_snippet, deck=deck))
+        self.reset_deck(prefetcher.user)
+
     def remove_snippet(self, snippet_id: int) -> None:
+        # the indexed values are needed to remove the snippet from the metadata indexes
+        snippet = self.get_snippet(snippet_id)
+
         snippet_key = f"snippet:{snippet_id}"
-        if not self.redis.exists(snippet_key):
+        with self.redis.pipeline() as pipe:
+            pipe.delete(snippet_key)
+            pipe.setbit("snippet_live", snippet_id, 0)
+            self._update_metadata_indexes(pipe, snippet_id, snippet.text, snippet.is_bot, dict(snippet.metadata), False)
+            if self.deduplicator is not None:
+                self.deduplicator.remove(pipe, snippet_id, SnippetDeduplicator.fingerprint(snippet.text))
+            deleted, *_ = pipe.execute()
+
+        if 0 >= deleted:
             raise KeyError(f"Snippet {snippet_id} does not exist.")
-        self.redis.delete(snippet_key)
+
+        self._set_live(snippet_id, False)
+        self.cache.invalidate(snippet_id)
+
+        for each_prefetcher in list(self._prefetchers):
+            each_prefetcher.discard(snippet_id)
@@ -0,0 +1,113 @@
+# coding=utf-8
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from loguru import logger
+
+from src.dataobjects import Snippet, User
+
+
+class SnippetPrefetcher:
+    def __init__(
+            self, get_next_snippet: Callable[[User], Snippet], user: User, executor: ThreadPoolExecutor,
+            depth: int = 3) -> None:
+        if 0 >= depth:
+            raise ValueError("Prefetch depth must be positive.")
+
+        self.user = user
+        self.depth = depth
+
+        self._get_next_snippet = get_next_snippet
+        self._executor = executor
+        self._buffer: deque[Future] = deque()
+        # removed ids mapped to the number of draws issued before the removal that are still buffered
+        self._removed_snippet_ids: dict[int, int] = dict()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def fill(self) -> None:
+        with self._lock:
+            while not self._closed and len(self._buffer) < self.depth:
+                self._buffer.append(self._executor.submit(self._get_next_snippet, self.user))
+
+    def _pop(self) -> Future | None:
+        with self._lock:
+            if 0 >= len(self._buffer):
+                return None
+
+            future = self._buffer.popleft()
+            # later draws already skip removed snippets, their ids are only kept for the older ones
+            for each_id in list(self._removed_snippet_ids):
+                self._removed_snippet_ids[each_id] -= 1
+                if 0 >= self._removed_snippet_ids[each_id]:
+                    del self._removed_snippet_ids[each_id]
+            return future
+
+    async def get_next_snippet(self) -> Snippet:
+        if self._closed:
+            raise ValueError("Prefetcher is closed.")
+
+        while True:
+            with self._lock:
+                removed_snippet_ids = set(self._removed_snippet_ids)
+            future = self._pop()
+
+            if future is None:
+                future = self._executor.submit(self._get_next_snippet, self.user)
+
+            # only waits if the user is faster than the storage, the event loop keeps serving other clients
+            snippet = await asyncio.wrap_future(future)
+
+            if snippet.db_id not in removed_snippet_ids:
+                break
+
+            logger.info(f"Dropping prefetched snippet {snippet.db_id}, it has been removed.")
+
+        self.fill()
+        return snippet
+
+    def discard(self, snippet_id: int) -> None:
+        with self._lock:
+            if 0 < len(self._buffer):
+                self._removed_snippet_ids[snippet_id] = len(self._buffer)
+
+    def set_source(self, get_next_snippet: Callable[[User], Snippet]) -> None:
+        with self._lock:
+            self._get_next_snippet = get_next_snippet
+
+    def clear(self, requeue: bool = True, refill: bool = True) -> None:
+        with self._lock:
+            futures = list(self._buffer)
+            removed_snippet_ids = set(self._removed_snippet_ids)
+            self._buffer.clear()
+            self._removed_snippet_ids.clear()
+
+        # draws that already started have taken their deck position, their snippets are kept in order
+        kept = list()
+        for each_future in futures:
+            if each_future.cancel():
+                continue
+            try:
+                snippet = each_future.result()
+            except Exception as e:
+                logger.warning(f"Dropping failed prefetch: {e}")
+                continue
+            if requeue and snippet.db_id not in removed_snippet_ids:
+                kept.append(each_future)
+            else:
+                logger.info(f"Dropping prefetched snippet {snippet.db_id} of the previous deck.")
+
+        with self._lock:
+            self._buffer.extendleft(reversed(kept))
+
+        if refill:
+            self.fill()
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            while 0 < len(self._buffer):
+                self._buffer.popleft().cancel()
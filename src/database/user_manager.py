@@ -1,6 +1,9 @@
 # coding=utf-8
+import dataclasses
 import hashlib
 import json
+import threading
+import time
 from collections import deque
 
 from redis import Redis
@@ -8,40 +11,164 @@ from redis import Redis
 from loguru import logger
 from redis.client import Pipeline
 
-from src.dataobjects import Friend, User, Face
+from src.dataobjects import Friend, User, Face, LeaderboardEntry
+
+# every write refreshes the expiration of the user hash, its name hash and its friends
+_REFRESH_USER = (
+    "local function refresh_user(user_key, expiration) "
+    "  local name_hash = redis.call('HGET', user_key, 'secret_name_hash') "
+    "  if not name_hash then return end "
+    "  redis.call('EXPIRE', user_key, expiration) "
+    "  redis.call('EXPIRE', user_key .. ':friends', expiration) "
+    "  redis.call('EXPIRE', 'name_hash:' .. name_hash, expiration) "
+    "end "
+)
+
+# one page of a leaderboard with the names and faces of its users, users that expired since are dropped
+_LEADERBOARD_PAGE = (
+    "local function leaderboard_page(board_key, start, stop) "
+    "  local page = {} "
+    "  local entries = redis.call('ZREVRANGE', board_key, start, stop, 'WITHSCORES') "
+    "  for i = 1, #entries, 2 do "
+    "    local card = redis.call('HMGET', 'user:' .. entries[i], 'public_name', 'face') "
+    "    if card[1] then "
+    "      table.insert(page, entries[i]) "
+    "      table.insert(page, entries[i + 1]) "
+    "      table.insert(page, card) "
+    "    else "
+    "      redis.call('ZREM', board_key, entries[i]) "
+    "    end "
+    "  end "
+    "  return page "
+    "end "
+)
 
 
 class UserManager:
-    def __init__(self, redis_conf: dict[str, str], expiration_seconds: int = 60 * 60 * 24 * 7 * 4 * 6) -> None:
+    leaderboards = ("wins", "accuracy")
+
+    def __init__(
+            self, redis_conf: dict[str, str], expiration_seconds: int = 60 * 60 * 24 * 7 * 4 * 6,
+            leaderboard_cache_seconds: float = 30.) -> None:
+
         self.redis = Redis(**redis_conf)
         logger.info("Users initialized.")
 
         self.expiration_seconds = expiration_seconds
 
-    def _reset_user_expiration(self, user_key: str, name_hash_key: str | None = None) -> None:
-        if name_hash_key is None:
-            secret_name_hash = self.redis.hget(user_key, "secret_name_hash")
-            name_hash_key = f"name_hash:{secret_name_hash}"
+        self._get_user_by_name_hash = self.redis.register_script(
+            "local user_id = redis.call('GET', KEYS[1]) "
+            "if not user_id then return nil end "
+            "return {user_id, redis.call('HGETALL', 'user:' .. user_id)}"
+        )
+
+        # returns friend ids alternating with their cards, ids of expired friends are dropped from the set
+        self._get_friend_cards = self.redis.register_script(
+            "local cards = {} "
+            "for _, friend_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do "
+            "  local card = redis.call('HMGET', 'user:' .. friend_id, 'face', 'public_name', 'wins', "
+            "    'false_positives', 'true_positives', 'false_negatives', 'true_negatives') "
+            "  if card[1] then "
+            "    table.insert(cards, friend_id) "
+            "    table.insert(cards, card) "
+            "  else "
+            "    redis.call('SREM', KEYS[1], friend_id) "
+            "  end "
+            "end "
+            "return cards"
+        )
+
+        # returns 0 if the name is taken, otherwise the new id and whether the inviter was befriended
+        self._create_user = self.redis.register_script(
+            _REFRESH_USER +
+            "if redis.call('EXISTS', KEYS[1]) == 1 then return 0 end "
+            "local user_id = redis.call('INCR', 'user_id_counter') "
+            "local user_key = 'user:' .. user_id "
+            "redis.call('HSET', user_key, 'db_id', user_id, unpack(ARGV, 3)) "
+            "redis.call('SET', KEYS[1], user_id) "
+            "refresh_user(user_key, ARGV[1]) "
+            "local inviter_key = 'user:' .. ARGV[2] "
+            "if tonumber(ARGV[2]) < 0 or redis.call('EXISTS', inviter_key) == 0 then return {user_id, 0} end "
+            "redis.call('SADD', inviter_key .. ':friends', user_id) "
+            "redis.call('SADD', user_key .. ':friends', ARGV[2]) "
+            "refresh_user(inviter_key, ARGV[1]) "
+            "refresh_user(user_key, ARGV[1]) "
+            "return {user_id, 1}"
+        )
+
+        # returns -1 or -2 if the first or the second user does not exist
+        self._make_friends = self.redis.register_script(
+            _REFRESH_USER +
+            "if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end "
+            "if redis.call('EXISTS', KEYS[2]) == 0 then return -2 end "
+            "redis.call('SADD', KEYS[1] .. ':friends', ARGV[3]) "
+            "redis.call('SADD', KEYS[2] .. ':friends', ARGV[2]) "
+            "refresh_user(KEYS[1], ARGV[1]) "
+            "local friend_expiration = redis.call('TTL', KEYS[2]) "
+            "if 0 < friend_expiration then redis.call('EXPIRE', KEYS[2] .. ':friends', friend_expiration) end "
+            "return 1"
+        )
+
+        self._remove_friendship = self.redis.register_script(
+            _REFRESH_USER +
+            "redis.call('SREM', KEYS[1] .. ':friends', ARGV[3]) "
+            "redis.call('SREM', KEYS[2] .. ':friends', ARGV[2]) "
+            "refresh_user(KEYS[1], ARGV[1]) "
+            "return 1"
+        )
+
+        # never recreates the hash of an expired user, returns 0 instead, keeps the leaderboards in step
+        self._update_user_script = self.redis.register_script(
+            _REFRESH_USER +
+            "if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end "
+            "if 3 < #ARGV then redis.call('HSET', KEYS[1], unpack(ARGV, 4)) end "
+            "local wins = redis.call('HINCRBY', KEYS[1], 'wins', ARGV[2]) "
+            "local rounds = redis.call('HINCRBY', KEYS[1], 'rounds', ARGV[3]) "
+            "local stats = redis.call('HMGET', KEYS[1], "
+            "  'true_positives', 'true_negatives', 'false_positives', 'false_negatives') "
+            "local correct = tonumber(stats[1]) + tonumber(stats[2]) "
+            "local total = correct + tonumber(stats[3]) + tonumber(stats[4]) "
+            "local accuracy = 0 "
+            # few rounds weigh the accuracy down, a lucky first guess does not top the board
+            "if 0 < total then accuracy = correct / total * rounds / (rounds + 10) end "
+            "local user_id = string.sub(KEYS[1], 6) "
+            "redis.call('ZADD', 'leaderboard:wins', wins, user_id) "
+            "redis.call('ZADD', 'leaderboard:accuracy', accuracy, user_id) "
+            "refresh_user(KEYS[1], ARGV[1]) "
+            "return 1"
+        )
+
+        # friends and the user themselves, the intersection is kept for a short while
+        self._friends_leaderboard = self.redis.register_script(
+            _LEADERBOARD_PAGE +
+            "if redis.call('EXISTS', KEYS[3]) == 0 then "
+            "  redis.call('ZINTERSTORE', KEYS[3], 2, KEYS[1], KEYS[2], 'WEIGHTS', 0, 1) "
+            "  local own_score = redis.call('ZSCORE', KEYS[2], ARGV[1]) "
+            "  if own_score then redis.call('ZADD', KEYS[3], own_score, ARGV[1]) end "
+            "  redis.call('EXPIRE', KEYS[3], ARGV[2]) "
+            "end "
+            "return leaderboard_page(KEYS[3], ARGV[3], ARGV[4])"
+        )
 
-        self.redis.expire(user_key, self.expiration_seconds)
-        self.redis.expire(name_hash_key, self.expiration_seconds)
+        self._leaderboard = self.redis.register_script(
+            _LEADERBOARD_PAGE +
+            "return leaderboard_page(KEYS[1], ARGV[1], ARGV[2])"
+        )
+        self.leaderboard_cache_seconds = leaderboard_cache_seconds
+        self._leaderboard_pages: dict[tuple[str, int, int], tuple[float, list[LeaderboardEntry]]] = dict()
+        self._leaderboard_lock = threading.Lock()
 
     def create_user(self, secret_name: str, face: Face, public_name: str, invited_by_user_id: int) -> User:
         secret_name_hash = hashlib.sha256(secret_name.encode()).hexdigest()
         name_hash_key = f"name_hash:{secret_name_hash}"
-        if self.redis.exists(name_hash_key):
-            raise ValueError("User already exists.")
-
-        user_id = int(self.redis.incr("user_id_counter"))
-        user_key = f"user:{user_id}"
         user = User(
             secret_name_hash=secret_name_hash,
             public_name=public_name,
             face=face,
-            db_id=user_id,
+            db_id=-1,
             invited_by_user_id=invited_by_user_id
         )
-        self.redis.hset(user_key, mapping={
+        fields = {
             "secret_name_hash":     secret_name_hash,
             "public_name":          public_name,
             "penalty":              int(user.penalty),
@@ -50,26 +177,28 @@ class UserManager:
             "true_negatives":       float(user.true_negatives),
             "false_positives":      float(user.false_positives),
             "false_negatives":      float(user.false_negatives),
-            "db_id":                user_id,
             "invited_by_user_id":   invited_by_user_id,
             "created_at":           user.created_at,
             "recent_snippet_ids":   json.dumps(list(user.recent_snippet_ids)),
-        })
-        self.redis.set(name_hash_key, user_id)
+        }
+        arguments = [self.expiration_seconds, invited_by_user_id]
+        for each_field, each_value in fields.items():
+            arguments.extend((each_field, each_value))
 
-        # only friend of new user is invitee
-        if invited_by_user_id >= 0:
-            self.make_friends(invited_by_user_id, user_id)  # also initializes expiration
+        # the id, the name hash and the friendship with the inviter are written at once
+        reply = self._create_user(keys=[name_hash_key], args=arguments)
+        if reply == 0:
+            raise ValueError("User already exists.")
 
-        logger.info(f"Created user {user_id}.")
-        return user
+        user_id, befriended = reply
+        if invited_by_user_id >= 0 and befriended == 0:
+            logger.warning(f"Inviting user {invited_by_user_id} does not exist anymore.")
 
-    def get_user_by_id(self, user_id: int) -> User | None:
-        user_key = f"user:{user_id}"
-        if not self.redis.exists(user_key):
-            return None
+        logger.info(f"Created user {user_id}.")
+        return dataclasses.replace(user, db_id=int(user_id))
 
-        result = self.redis.hgetall(user_key)
+    @staticmethod
+    def _user_from_hash(user_id: int, result: dict[bytes, bytes]) -> User:
         data = {
             key.decode(): value.decode()
             for key, value in result.items()
@@ -94,60 +223,64 @@ class UserManager:
             db_id=user_id,
             invited_by_user_id=data.pop("invited_by_user_id"),
             created_at=data.pop("created_at"),
-            recent_snippet_ids=deque(recent_snippet_ids)
+            recent_snippet_ids=deque(recent_snippet_ids, maxlen=100)
         )
         return user
 
+    def get_user_by_id(self, user_id: int) -> User | None:
+        user_key = f"user:{user_id}"
+        result = self.redis.hgetall(user_key)
+        if len(result) < 1:
+            return None
+
+        return self._user_from_hash(user_id, result)
+
     def get_user(self, secret_name_hash: str) -> User | None:
         name_hash_key = f"name_hash:{secret_name_hash}"
-        if not self.redis.exists(name_hash_key):
+        # resolves the name hash and reads the user hash on the server
+        reply = self._get_user_by_name_hash(keys=[name_hash_key])
+        if reply is None:
+            return None
+
+        user_id, flat_hash = reply
+        result = dict(zip(flat_hash[::2], flat_hash[1::2]))
+        if len(result) < 1:
             return None
 
-        user_id = int(self.redis.get(name_hash_key))
-        return self.get_user_by_id(user_id)
+        return self._user_from_hash(int(user_id), result)
 
     def delete_user(self, user_id: int) -> None:
         # delete_user(243)
         user_key = f"user:{user_id}"
-        if not self.redis.exists(user_key):
+        secret_name_hash = self.redis.hget(user_key, "secret_name_hash")
+        if secret_name_hash is None:
             raise KeyError(f"User {user_id} does not exist.")
 
-        secret_name_hash = self.redis.hget(user_key, "secret_name_hash")
         name_hash_key = f"name_hash:{secret_name_hash.decode()}"
-        if not self.redis.exists(name_hash_key):
-            raise KeyError(f"User with name hash {secret_name_hash} does not exist.")
 
         friends = self.get_friends(user_id)
 
         with self.redis.pipeline() as pipe:
             for each_friend in friends:
                 self._remove_friend_unidirectional(each_friend.db_id, user_id, pipeline=pipe)
+            for each_board in UserManager.leaderboards:
+                pipe.zrem(f"leaderboard:{each_board}", user_id)
+            pipe.delete(name_hash_key, user_key, f"{user_key}:friends")
             pipe.execute()
 
-        self.redis.delete(name_hash_key)
-        self.redis.delete(user_key)
-
     def make_friends(self, user_id: int, friend_id: int) -> None:
         # make_friends('JohnDoe', 'JaneDoe')
         if user_id == friend_id:
             raise ValueError("Cannot befriend oneself.")
 
-        user_key = f"user:{user_id}"
-        if not self.redis.exists(user_key):
+        reply = self._make_friends(
+            keys=[f"user:{user_id}", f"user:{friend_id}"], args=[self.expiration_seconds, user_id, friend_id]
+        )
+        if reply == -1:
             raise KeyError(f"User {user_id} does not exist.")
-
-        friend_key = f"user:{friend_id}"
-        if not self.redis.exists(friend_key):
+        if reply == -2:
             raise KeyError(f"User {friend_id} does not exist.")
 
-        users_friends_key = f"{user_key}:friends"
-        friends_friends_key = f"{friend_key}:friends"
-
-        self.redis.sadd(users_friends_key, friend_id)
-        self.redis.sadd(friends_friends_key, user_id)
-
-        self._reset_user_expiration(user_key)
-
     def _remove_friend_unidirectional(self, user_id: int, friend_id: int, pipeline: Pipeline | None) -> None:
         # remove_friend_unidirectional(234, 523)
         users_friends_key = f"user:{user_id}:friends"
@@ -159,61 +292,53 @@ class UserManager:
 
     def remove_friendship(self, user_id: int, friend_id: int) -> None:
         # remove_friendship(234, 523)
-        self._remove_friend_unidirectional(user_id, friend_id, pipeline=None)
-        self._remove_friend_unidirectional(friend_id, user_id, pipeline=None)
-
-        self._reset_user_expiration(f"user:{user_id}")
+        self._remove_friendship(
+            keys=[f"user:{user_id}", f"user:{friend_id}"], args=[self.expiration_seconds, user_id, friend_id]
+        )
 
     def get_friends(self, user_id: int) -> set[Friend]:
         users_friends_key = f"user:{user_id}:friends"
+        reply = self._get_friend_cards(keys=[users_friends_key])
+
         friends = set()
-        if not self.redis.exists(users_friends_key):
-            return friends
-
-        friend_ids = self.redis.smembers(users_friends_key)
-        for each_friend_id in friend_ids:
-            friend_key = f"user:{each_friend_id.decode()}"
-            if not self.redis.exists(friend_key):
-                raise KeyError(f"User {friend_key} does not exist.")
-
-            face_id = self.redis.hget(friend_key, "face")
-            public_name = self.redis.hget(friend_key, "public_name")
-            false_positives = float(self.redis.hget(friend_key, "false_positives"))
-            true_positives = float(self.redis.hget(friend_key, "true_positives"))
-            false_negatives = float(self.redis.hget(friend_key, "false_negatives"))
-            true_negatives = float(self.redis.hget(friend_key, "true_negatives"))
+        for each_friend_id, each_card in zip(reply[::2], reply[1::2]):
+            face_id, public_name, wins, *counts = each_card
+            false_positives, true_positives, false_negatives, true_negatives = (
+                float(each_count) for each_count in counts
+            )
             positives = false_positives + true_positives
             negatives = false_negatives + true_negatives
             anger = 0. if 0 >= positives else false_positives / positives
             sadness = 0. if 0 >= negatives else false_negatives / negatives
-            wins = int(true_positives + true_negatives)
             each_friend = Friend(
                 db_id=int(each_friend_id),
                 name=public_name.decode(),
                 face=Face(face_id.decode()),
                 anger=anger,
                 sadness=sadness,
-                wins=wins,
+                wins=0 if wins is None else int(wins),
             )
             friends.add(each_friend)
 
         return friends
 
-    def set_user_penalty(self, user: User, penalty: bool) -> None:
-        user_key = f"user:{user.db_id}"
-        self.redis.hset(user_key, mapping={
-            "penalty": int(penalty)
-        })
+    def _update_user(
+            self, user_id: int, fields: dict[str, int | float], new_wins: int = 0, new_rounds: int = 0) -> None:
+        arguments = [self.expiration_seconds, new_wins, new_rounds]
+        for each_field, each_value in fields.items():
+            arguments.extend((each_field, each_value))
 
-        self._reset_user_expiration(user_key)
+        if self._update_user_script(keys=[f"user:{user_id}"], args=arguments) == 0:
+            raise KeyError(f"User {user_id} does not exist.")
+
+    def set_user_penalty(self, user: User, penalty: bool) -> None:
+        self._update_user(user.db_id, {"penalty": int(penalty)})
 
     def update_user_state(self, user: User,
                           true_positive: float, false_positive: float,
                           true_negative: float, false_negative: float) -> None:
 
-        user_key = f"user:{user.db_id}"
-
-        self.redis.hset(user_key, mapping={
+        self._update_user(user.db_id, {
             "true_positives": true_positive,
             "false_positives": false_positive,
             "true_negatives": true_negative,
@@ -221,4 +346,59 @@ class UserManager:
             "penalty": 0
         })
 
-        self._reset_user_expiration(user_key)
+    def save_user_state(self, user: User, new_wins: int = 0, new_rounds: int = 0) -> None:
+        self._update_user(user.db_id, {
+            "true_positives": user.true_positives,
+            "false_positives": user.false_positives,
+            "true_negatives": user.true_negatives,
+            "false_negatives": user.false_negatives,
+            "penalty": int(user.penalty),
+            "recent_snippet_ids": json.dumps(list(user.recent_snippet_ids)),
+        }, new_wins=new_wins, new_rounds=new_rounds)
+
+    @staticmethod
+    def _leaderboard_entries(offset: int, page: list) -> list[LeaderboardEntry]:
+        return [
+            LeaderboardEntry(
+                rank=offset + each_index + 1,
+                db_id=int(each_user_id),
+                name=public_name.decode(),
+                face=Face(face_id.decode()),
+                score=float(each_score)
+            )
+            for each_index, (each_user_id, each_score, (public_name, face_id))
+            in enumerate(zip(page[::3], page[1::3], page[2::3]))
+        ]
+
+    def get_leaderboard(self, board: str = "wins", offset: int = 0, count: int = 10) -> list[LeaderboardEntry]:
+        if board not in UserManager.leaderboards:
+            raise ValueError(f"Unknown leaderboard {board}.")
+
+        # every start page shows the same top entries, they are only read again once they are stale
+        page_key = board, offset, count
+        now = time.monotonic()
+        with self._leaderboard_lock:
+            cached = self._leaderboard_pages.get(page_key)
+            if cached is not None and now < cached[0]:
+                return cached[1]
+
+        page = self._leaderboard(keys=[f"leaderboard:{board}"], args=[offset, offset + count - 1])
+        entries = UserManager._leaderboard_entries(offset, page)
+
+        with self._leaderboard_lock:
+            self._leaderboard_pages = {
+                each_key: each_value for each_key, each_value in self._leaderboard_pages.items()
+                if now < each_value[0]
+            }
+            self._leaderboard_pages[page_key] = now + self.leaderboard_cache_seconds, entries
+        return entries
+
+    def get_friends_leaderboard(
+            self, user_id: int, board: str = "wins", offset: int = 0, count: int = 10) -> list[LeaderboardEntry]:
+        if board not in UserManager.leaderboards:
+            raise ValueError(f"Unknown leaderboard {board}.")
+
+        keys = [f"user:{user_id}:friends", f"leaderboard:{board}", f"leaderboard:{board}:friends:{user_id}"]
+        arguments = [user_id, max(1, int(self.leaderboard_cache_seconds)), offset, offset + count - 1]
+        page = self._friends_leaderboard(keys=keys, args=arguments)
+        return UserManager._leaderboard_entries(offset, page)
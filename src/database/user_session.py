@@ -0,0 +1,107 @@
+# coding=utf-8
+import asyncio
+import dataclasses
+import threading
+from collections import Counter, deque
+from typing import Callable
+
+from loguru import logger
+
+from src.dataobjects import User
+
+
+class UserSession:
+    def __init__(
+            self, save_user_state: Callable[[User, int, int], None],
+            update_markers: Callable[[list[tuple[Counter, bool]]], None], user: User) -> None:
+
+        self._save_user_state = save_user_state
+        self._update_markers = update_markers
+
+        self._user = user
+        self._user_changed = False
+        self._new_wins = 0
+        self._new_rounds = 0
+        self._marker_updates: list[tuple[Counter, bool]] = list()
+
+        # changes are collected under the state lock, flushes write them one after another
+        self._state_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = False
+
+    @property
+    def user(self) -> User:
+        return self._user
+
+    def set_penalty(self, penalty: bool) -> None:
+        with self._state_lock:
+            self._user = dataclasses.replace(self._user, penalty=penalty)
+            self._user_changed = True
+
+    def set_stats(
+            self, true_positives: float, false_positives: float,
+            true_negatives: float, false_negatives: float) -> None:
+
+        with self._state_lock:
+            self._user = dataclasses.replace(
+                self._user,
+                true_positives=true_positives, false_positives=false_positives,
+                true_negatives=true_negatives, false_negatives=false_negatives
+            )
+            self._user_changed = True
+
+    def add_recent_snippet(self, snippet_id: int) -> None:
+        with self._state_lock:
+            self._user.recent_snippet_ids.append(snippet_id)
+            self._user_changed = True
+
+    def add_round(self, won: bool) -> None:
+        with self._state_lock:
+            self._new_wins += int(won)
+            self._new_rounds += 1
+            self._user_changed = True
+
+    def add_markers(self, markers: Counter, correct: bool) -> None:
+        with self._state_lock:
+            # the caller keeps reusing its counter
+            self._marker_updates.append((Counter(markers), correct))
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._state_lock:
+                # the recent snippets keep changing on the event loop while the copy is written
+                user = None if not self._user_changed else dataclasses.replace(
+                    self._user, recent_snippet_ids=deque(self._user.recent_snippet_ids, maxlen=100)
+                )
+                new_wins, new_rounds = self._new_wins, self._new_rounds
+                marker_updates = self._marker_updates
+                self._user_changed = False
+                self._new_wins = self._new_rounds = 0
+                self._marker_updates = list()
+
+            # a flush writes the user in one atomic script, storage never holds half a round
+            try:
+                if user is not None:
+                    self._save_user_state(user, new_wins, new_rounds)
+                    # counters are increments, they must not be written twice if the markers fail
+                    user, new_wins, new_rounds = None, 0, 0
+                if 0 < len(marker_updates):
+                    self._update_markers(marker_updates)
+
+            except Exception as e:
+                logger.error(f"Flushing session of user {self._user.db_id} failed: {e}")
+                with self._state_lock:
+                    self._user_changed = self._user_changed or user is not None
+                    self._new_wins += new_wins
+                    self._new_rounds += new_rounds
+                    self._marker_updates = marker_updates + self._marker_updates
+                raise
+
+    async def flush_in_background(self) -> None:
+        if self._closed:
+            return
+        await asyncio.to_thread(self.flush)
+
+    async def close(self) -> None:
+        self._closed = True
+        await asyncio.to_thread(self.flush)
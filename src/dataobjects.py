@@ -1,10 +1,15 @@
 from __future__ import annotations
 
 import dataclasses
+import hashlib
 import random
 import time
 from collections import deque, Counter
-from typing import Callable
+from typing import Callable, Generator, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from src.database.snippet_prefetcher import SnippetPrefetcher
+    from src.database.user_session import UserSession
 
 
 def get_random_face_id() -> str:
@@ -27,6 +32,15 @@ class Friend:
     wins: int = 0
 
 
+@dataclasses.dataclass(frozen=True)
+class LeaderboardEntry:
+    rank: int
+    db_id: int
+    name: str
+    face: Face
+    score: float
+
+
 @dataclasses.dataclass(frozen=True)
 class User:
     secret_name_hash: str
@@ -47,14 +61,60 @@ class User:
     recent_snippet_ids: deque[int] = dataclasses.field(default_factory=lambda: deque(maxlen=100))
 
 
+TOKEN = tuple[int, int, int]  # line number, start offset, end offset
+
+
+def tokenize(text: str) -> tuple[TOKEN, ...]:
+    tokens = list()
+    line_start = 0
+    for line_number, each_line in enumerate(text.split("\n")):
+        word_start = line_start
+        for each_word in each_line.split(" "):
+            stripped = each_word.strip()
+            if 0 < len(stripped):
+                start = word_start + each_word.index(stripped)
+                tokens.append((line_number, start, start + len(stripped)))
+            word_start += len(each_word) + 1
+        line_start += len(each_line) + 1
+    return tuple(tokens)
+
+
 @dataclasses.dataclass(frozen=True)
 class Snippet:
     text: str
     source: str
     is_bot: bool
     metadata: tuple[tuple[str, str | int], ...] = dataclasses.field(default_factory=tuple)
+    # offsets into `text`, computed once at ingestion so that tags can be attributed to token positions
+    tokens: tuple[TOKEN, ...] = dataclasses.field(default_factory=tuple)
     db_id: int = -1
 
+    @property
+    def word_count(self) -> int:
+        return len(self.tokens)
+
+    @property
+    def max_points(self) -> int:
+        return self.word_count // 4
+
+    def words(self) -> Generator[tuple[int, str], None, None]:
+        for line_number, start, end in self.tokens:
+            yield line_number, self.text[start:end]
+
+
+@dataclasses.dataclass(frozen=True)
+class SnippetDeck:
+    channel: str | None = None
+    min_likes: int | None = None
+    max_likes: int | None = None
+    min_length: int | None = None
+    max_length: int | None = None
+    is_bot: bool | None = None
+
+    @property
+    def deck_id(self) -> str:
+        return hashlib.sha256(repr(self).encode()).hexdigest()[:16]
+
 
 @dataclasses.dataclass(frozen=True)
 class ViewCallbacks:
@@ -73,6 +133,10 @@ class ViewCallbacks:
     remove_friendship: Callable[[int, int], None]
     get_user_by_id: Callable[[int], User | None]
     remove_invitation_link: Callable[[str], None]
+    create_snippet_prefetcher: Callable[[User], SnippetPrefetcher]
+    create_user_session: Callable[[User], UserSession]
+    get_leaderboard: Callable[[str, int, int], list[LeaderboardEntry]]
+    get_friends_leaderboard: Callable[[int, str, int, int], list[LeaderboardEntry]]
 
 
 @dataclasses.dataclass
@@ -1,10 +1,11 @@
 from nicegui import ui
 
 from src.dataobjects import Face
+from src.gui.tools import portrait_url
 
 
 def show_face(face: Face) -> ui.element:
     # face_image = ui.image(f"assets/images/portraits/{face.source_id}-2.jpg")
-    face_image = ui.image(f"assets/images/portraits/{face.source_id}-2.png")
+    face_image = ui.image(portrait_url(face.source_id, "2", 512))
     # face_label = ui.label(str(face_seed))
     return face_image
@@ -1,4 +1,3 @@
-import re
 from collections import Counter
 from typing import Callable, Coroutine
 
@@ -10,7 +9,7 @@ from src.gui.tools import colorize
 
 class InteractiveText:
     def __init__(self,
-                 get_snippet: Callable[[], Snippet],
+                 get_snippet: Callable[[], Coroutine[any, any, Snippet]],
                  get_submit_button: Callable[[], ui.button],
                  get_successful_tags: Callable[[int, int], set[tuple[str, float]]],
                  ) -> None:
@@ -71,28 +70,29 @@ class InteractiveText:
 
         print(self.signs_dict)
 
-    def _update_snippet_text(self, text: str) -> None:
+    def _update_snippet_text(self, snippet: Snippet) -> None:
         self._text_content.clear()
-        lines = text.split("\n")
         with self._text_content:
-            for line_number, each_line in enumerate(lines):
-                with ui.row() as text_content_clickable:
-                    text_content_clickable.classes("gap-y-0 ")
-                    for each_word in re.split(" ", each_line):
-                        if len(each_word) < 1:
-                            continue
-
-                        each_word = each_word.strip()
-                        label_word = ui.label(each_word)
-                        label_word.on("click", lambda event: self._click_event(event.sender))
-                        label_word.sus_sign = None
-                        label_word.classes("cursor-pointer ")
-                        label_word.classes("word untagged ")
-
-    def update_content(self) -> None:
-        self.snippet = self.get_snippet()
+            line_number = -1
+            text_content_clickable = None
+            # tokens are computed at ingestion, empty lines only advance the line number
+            for each_line_number, each_word in snippet.words():
+                while line_number < each_line_number:
+                    line_number += 1
+                    with ui.row() as text_content_clickable:
+                        text_content_clickable.classes("gap-y-0 ")
+
+                with text_content_clickable:
+                    label_word = ui.label(each_word)
+                    label_word.on("click", lambda event: self._click_event(event.sender))
+                    label_word.sus_sign = None
+                    label_word.classes("cursor-pointer ")
+                    label_word.classes("word untagged ")
+
+    async def update_content(self) -> None:
+        self.snippet = await self.get_snippet()
         self._source_content = self.snippet.source
-        self._update_snippet_text(self.snippet.text)
+        self._update_snippet_text(self.snippet)
         self._update_signs()
         self.colorized_signs = colorize(self.signs_dict)
 
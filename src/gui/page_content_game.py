@@ -4,11 +4,13 @@ import os
 from loguru import logger
 from nicegui import ui, Client
 
+from src.database.snippet_prefetcher import SnippetPrefetcher
+from src.database.user_session import UserSession
 from src.dataobjects import ViewCallbacks, User, BinaryStats
 from src.gui.elements.content_class import ContentPage
 from src.gui.elements.dialogs import info_dialog
 from src.gui.elements.interactive_text import InteractiveText
-from src.gui.tools import get_from_local_storage
+from src.gui.tools import get_from_local_storage, portrait_url, preload_images
 
 
 class GameContent(ContentPage):
@@ -28,9 +30,12 @@ class GameContent(ContentPage):
         self._points = self._max_points = -1
 
         self._interactive_text: InteractiveText | None = None
+        self._prefetcher: SnippetPrefetcher | None = None
 
         self._timer: ui.timer = ui.timer(1, self._decrement_points, active=False)
         self._user: User | None = None
+        self._session: UserSession | None = None
+        self._flush_seconds = 30.
 
     def _init_javascript(self, button_id: str) -> None:
         init_js = (
@@ -80,39 +85,54 @@ class GameContent(ContentPage):
 
         self._user = self.callbacks.get_user(name_hash)
 
-    async def _apply_penalty(self, user: User) -> None:
+    async def _flush_session(self) -> None:
+        # the session keeps whatever it could not write and retries with the next flush
+        try:
+            await self._session.flush_in_background()
+
+        except Exception as e:
+            logger.error(f"Could not store the session of user {self._user.db_id}: {e}")
+
+    async def _apply_penalty(self) -> None:
+        user = self._session.user
         penalize = user.penalty
         logger.info(f"This round penalty: {penalize}")
 
         if penalize:
             false_positives = user.false_positives + 5.
             false_negatives = user.false_negatives + 5.
-            self.callbacks.update_user_state(user, 0, false_positives, 0, false_negatives)
+            self._session.set_stats(0, false_positives, 0, false_negatives)
 
+        # stored right away, it stays set whenever a session ends without "Beenden" or crashes
+        self._session.set_penalty(True)
+        await self._flush_session()
+        logger.info("Setting penalty.")
+
+        if penalize:
             await info_dialog(
                 "Du hast das letzte mal abgebrochen. Dafür bekommst du Strafpunkte :( Versuch bitte immer das "
                 "Spiel über den \"Beenden\"-Button zu beenden."
             )
 
-        else:
-            self.callbacks.set_user_penalty(user, True)
-            logger.info("Setting penalty.")
-
     async def _add_text_element(self) -> None:
+        # next rounds are read ahead in the background while the user is busy with the current one
+        self._prefetcher = self.callbacks.create_snippet_prefetcher(self._user)
+        self.client.on_disconnect(self._prefetcher.close)
+
         self._interactive_text = InteractiveText(
-            lambda: self.callbacks.get_next_snippet(self._user),
+            self._prefetcher.get_next_snippet,
             lambda: self._submit_button,
             self.callbacks.most_successful_markers
         )
         self._interactive_text.generate_content()
 
-    def _update_text(self) -> None:
+    async def _update_text(self) -> None:
         self.progress_bar.classes(remove="bg-red-500 bg-yellow-500 ")
         self.progress_bar.classes(add="bg-green-500 ")
         self.progress_bar.style(f"width: 100%;")
 
         self._timer.activate()
-        self._interactive_text.update_content()
+        await self._interactive_text.update_content()
         self._interactive_text.reset_tagged_word_count()
         # reset button label
         js = (
@@ -120,8 +140,7 @@ class GameContent(ContentPage):
         )
         _ = ui.run_javascript(js)
         snippet = self._interactive_text.snippet
-        word_count = len(snippet.text.split())
-        self._points = self._max_points = word_count // 4
+        self._points = self._max_points = snippet.max_points
 
     def _add_timing(self) -> None:
         self._timer.activate()
@@ -174,7 +193,7 @@ class GameContent(ContentPage):
             name.classes("text-center text-base w-full ")
             pass
 
-        with ui.image(f"assets/images/portraits/{self._user.face.source_id}-{state}.png") as image:
+        with ui.image(portrait_url(self._user.face.source_id, state, 512)) as image:
             image.classes("mx-auto w-32 md:w-64 ")
             image.style("image-rendering: pixelated;")
 
@@ -217,11 +236,12 @@ class GameContent(ContentPage):
         print("binary_stats_this_round")
         print(binary_stats_this_round)
 
+        user = self._session.user
         last_binary_stats_user = BinaryStats(
-            self._user.true_positives,
-            self._user.true_negatives,
-            self._user.false_positives,
-            self._user.false_negatives
+            user.true_positives,
+            user.true_negatives,
+            user.false_positives,
+            user.false_negatives
         )
         print("last_binary_stats_user")
         print(last_binary_stats_user)
@@ -233,8 +253,7 @@ class GameContent(ContentPage):
         print(f"new_binary_stats_user ({self._points}/{self._max_points})")
         print(new_binary_stats_user)
 
-        self.callbacks.update_user_state(
-            self._user,
+        self._session.set_stats(
             new_binary_stats_user.true_positives, new_binary_stats_user.false_positives,
             new_binary_stats_user.true_negatives, new_binary_stats_user.false_negatives
         )
@@ -259,19 +278,22 @@ class GameContent(ContentPage):
         classified_positive = len(tags) >= 1
         true = actually_positive == classified_positive
 
-        self._user.recent_snippet_ids.append(snippet_id)
+        # only buffered, the session writes them in the background
+        self._session.add_recent_snippet(snippet_id)
+        self._session.add_round(true)
 
         if classified_positive:
-            self.callbacks.update_markers(tags, true)
+            self._session.add_markers(tags, true)
 
         selection = await self._feedback_dialog(actually_positive, classified_positive, self._interactive_text)
-        self.callbacks.set_user_penalty(self._user, False)
+        self._session.set_penalty(False)
         self._update_stats(classified_positive, true)
 
         if selection == "continue":
-            self._update_text()
+            await self._update_text()
 
         else:
+            await self._flush_session()
             ui.open("/")
 
     def button_green(self) -> None:
@@ -285,7 +307,13 @@ class GameContent(ContentPage):
 
         await self.client.connected()
         await self._check_user()
-        await self._apply_penalty(self._user)
+        self._session = self.callbacks.create_user_session(self._user)
+        self.client.on_disconnect(self._session.close)
+        ui.timer(self._flush_seconds, self._flush_session)
+        await self._apply_penalty()
+
+        # every feedback shows one of the states, loading them now makes the avatar appear without delay
+        preload_images([portrait_url(self._user.face.source_id, each_state, 512) for each_state in "012"])
 
         header_classes = "text-2xl font-semibold text-center py-2 "
 
@@ -306,4 +334,4 @@ class GameContent(ContentPage):
                 self._submit_button.classes("w-4/5 ")
 
         self._init_javascript(f"c{self._submit_button.id}")
-        self._update_text()
+        await self._update_text()
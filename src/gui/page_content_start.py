@@ -5,10 +5,12 @@ from urllib.parse import urlparse
 from loguru import logger
 from nicegui import Client, ui
 
-from src.dataobjects import ViewCallbacks, User, Face
+from src.dataobjects import ViewCallbacks, User, Face, LeaderboardEntry
 from src.gui.elements.content_class import ContentPage
 from src.gui.elements.dialogs import info_dialog, option_dialog, input_dialog
-from src.gui.tools import get_from_local_storage, remove_from_local_storage, serve_id_file, set_in_local_storage
+from src.gui.tools import (
+    get_from_local_storage, portrait_url, remove_from_local_storage, serve_id_file, set_in_local_storage
+)
 
 
 class StartContent(ContentPage):
@@ -189,7 +191,7 @@ class StartContent(ContentPage):
             elif false_positive_rate >= .2 and false_positive_rate >= false_negative_rate:
                 state = "1"
 
-        with ui.image(f"assets/images/portraits/{self._face.source_id}-{state}.png") as image:
+        with ui.image(portrait_url(self._face.source_id, state, 512)) as image:
             image.classes("w-64 rounded z-0 ").style("image-rendering: pixelated;")
 
         with ui.button() as login_button:
@@ -296,7 +298,7 @@ class StartContent(ContentPage):
                         elif each_friend.sadness >= .2 and each_friend.sadness >= each_friend.anger:
                             state = "0"
 
-                        with ui.image(f"assets/images/portraits/{each_friend.face.source_id}-{state}.png") as image:
+                        with ui.image(portrait_url(each_friend.face.source_id, state, 320)) as image:
                             pass
 
                         with ui.label(each_friend.name) as name:
@@ -314,6 +316,39 @@ class StartContent(ContentPage):
                     invite_button.classes("w-20 md:w-40 ")
                     invite_button.props("id=\"inviteButton\"")
 
+    def _create_leaderboard(self, header_text: str, entries: list[LeaderboardEntry]) -> None:
+        with ui.element("div") as board:
+            board.classes("flex flex-col w-full ")
+            with ui.label(header_text) as header:
+                header.classes("text-lg mb-2 text-center ")
+
+            with ui.element("ol") as box:
+                box.classes("flex flex-col bg-indigo-200 rounded p-2 ")
+                for each_entry in entries:
+                    with ui.row() as row:
+                        row.classes("items-center gap-2 ")
+                        if self._user is not None and each_entry.db_id == self._user.db_id:
+                            row.classes("font-semibold ")
+                        ui.label(f"{each_entry.rank}.")
+                        with ui.image(portrait_url(each_entry.face.source_id, "2", 160)) as image:
+                            image.classes("w-8 rounded ")
+                        ui.label(each_entry.name)
+                        ui.label(f"{each_entry.score:.0f}")
+
+    async def _create_leaderboard_container(self) -> None:
+        # each board is a single page read, no matter how many players there are
+        with ui.element("div") as container:
+            container.classes("py-8 w-full ")
+
+            with ui.label("Bestenliste") as header:
+                header.classes(self._header_classes)
+
+            with ui.element("div") as boards:
+                boards.classes("grid grid-cols-1 md:grid-cols-2 gap-4 ")
+                self._create_leaderboard("Alle", self.callbacks.get_leaderboard("wins", 0, 10))
+                friends_entries = self.callbacks.get_friends_leaderboard(self._user.db_id, "wins", 0, 10)
+                self._create_leaderboard("Freunde", friends_entries)
+
     async def _create_footer_container(self) -> None:
         with ui.element("div") as container:
             container.classes(" ")
@@ -358,6 +393,8 @@ class StartContent(ContentPage):
             if self._user is not None:
                 await self._create_friends_container()
                 ui.separator()
+                await self._create_leaderboard_container()
+                ui.separator()
             # await self._create_footer_container()
 
         await self._set_domain()
@@ -1,4 +1,7 @@
 import datetime
+import functools
+import json
+import pathlib
 import string
 import tempfile
 
@@ -50,6 +53,63 @@ def colorize(signs_dict: dict[str, float]) -> tuple[tuple[str, str], ...]:
     return tuple((each_sign, next(color_generator)) for each_sign in signs)
 
 
+@functools.cache
+def _portrait_derivatives() -> dict[str, dict[str, dict[str, str]]]:
+    # written by `src/tools/faces/build_portraits.py`, without it the original portraits are served
+    manifest_path = pathlib.Path("assets/images/portraits/derivatives.json")
+    if not manifest_path.is_file():
+        logger.warning("No portrait derivatives found, serving original portraits.")
+        return dict()
+
+    with manifest_path.open(mode="r") as manifest_file:
+        return json.load(manifest_file)
+
+
+def portrait_url(face_id: str, state: str, width: int, image_format: str = "webp") -> str:
+    widths = _portrait_derivatives().get(f"{face_id}-{state}", dict()).get(image_format)
+    if not widths:
+        return f"assets/images/portraits/{face_id}-{state}.png"
+
+    # the smallest derivative that is not scaled up, otherwise the largest one
+    sizes = sorted(widths, key=int)
+    size = next((each_size for each_size in sizes if width <= int(each_size)), sizes[-1])
+    return widths[size]
+
+
+@functools.cache
+def _avif_alternatives() -> dict[str, str]:
+    alternatives = dict()
+    for each_formats in _portrait_derivatives().values():
+        webp_urls, avif_urls = each_formats.get("webp", dict()), each_formats.get("avif", dict())
+        for each_width, each_url in webp_urls.items():
+            avif_url = avif_urls.get(each_width)
+            if avif_url is not None:
+                alternatives[f"/{each_url}"] = f"/{avif_url}"
+    return alternatives
+
+
+def negotiate_portrait_path(path: str, accept: str) -> str:
+    # pages always link the webp derivative, browsers that accept avif get the smaller file under the same url
+    if "image/avif" not in accept:
+        return path
+    return _avif_alternatives().get(path, path)
+
+
+def preload_images(urls: list[str]) -> None:
+    try:
+        command = (
+            f"for (const url of {json.dumps(urls)}) {{"
+            "    const link = document.createElement('link');"
+            "    link.rel = 'preload'; link.as = 'image'; link.href = url;"
+            "    document.head.appendChild(link);"
+            "}"
+        )
+        _ = ui.run_javascript(command)
+
+    except TimeoutError as e:
+        logger.error(e)
+
+
 def download_vcard(secret_name: str, public_name: str, face_id: str) -> tuple[str, str]:
     ram_disk_path = "/dev/shm/"
     now = datetime.datetime.now()
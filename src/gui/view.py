@@ -5,6 +5,7 @@ from src.gui.dummies import DummyContent
 from src.dataobjects import ViewCallbacks
 from src.gui.page_content_game import GameContent
 from src.gui.page_content_start import StartContent
+from src.gui.tools import negotiate_portrait_path
 
 
 class View:
@@ -12,6 +13,20 @@ class View:
         self.callbacks: ViewCallbacks | None = None
         app.add_static_files(url_path="/assets", local_directory="assets")
 
+        @app.middleware("http")
+        async def serve_portrait_derivatives(request, call_next):
+            path = request.url.path
+            if not path.startswith("/assets/images/portraits/derived/"):
+                return await call_next(request)
+
+            request.scope["path"] = negotiate_portrait_path(path, request.headers.get("accept", ""))
+            response = await call_next(request)
+            response.headers["Vary"] = "Accept"
+            # derivative names change with their content, browsers never need to revalidate them
+            if response.status_code == 200:
+                response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+            return response
+
     def set_callbacks(self, callback: ViewCallbacks) -> None:
         self.callbacks = callback
 
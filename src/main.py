@@ -29,12 +29,19 @@ def main() -> None:
         },
         "openai": {
             "key": os.environ.get("OPENAI_API_KEY"),
+            "base_url": os.environ.get("OPENAI_BASE_URL"),
             "parameters": {
                 "model": os.environ.get("OPENAI_MODEL", "gpt-4-1106-preview"),
                 "temperature": float(os.environ.get("OPENAI_TEMPERATURE", 0)),
                 "top_p": os.environ.get("OPENAI_TOP_P"),
             },
         },
+        "snippets": {
+            # share of bot snippets drawn, unset keeps the distribution of the stored snippets
+            "bot_ratio": float(os.environ["SNIPPETS_BOT_RATIO"]) if os.environ.get("SNIPPETS_BOT_RATIO") else None,
+            # threads reading snippets ahead for all users together
+            "prefetch_workers": int(os.environ.get("SNIPPETS_PREFETCH_WORKERS", 8)),
+        },
         "redis": {
             "users_database": {
                 "host": os.environ.get("REDIS_HOST", "localhost"),
@@ -0,0 +1,81 @@
+# coding=utf-8
+import argparse
+import hashlib
+import io
+import json
+import pathlib
+
+from PIL import Image
+
+from src.tools.misc import write_atomically
+
+
+def encode(image: Image.Image, width: int, image_format: str, quality: int) -> bytes:
+    height = round(image.height * width / image.width)
+    resized = image.resize((width, height), Image.LANCZOS)
+    buffer = io.BytesIO()
+    resized.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def build_portraits(
+        source_dir: str = "assets/images/portraits", widths: tuple[int, ...] = (160, 320, 512),
+        formats: tuple[str, ...] = ("webp", "avif"), quality: int = 80) -> dict[str, dict[str, dict[str, str]]]:
+
+    source_path = pathlib.Path(source_dir)
+    target_path = source_path / "derived"
+    target_path.mkdir(exist_ok=True)
+
+    available = set(Image.registered_extensions())
+    usable_formats = list()
+    for each_format in formats:
+        if f".{each_format}" in available:
+            usable_formats.append(each_format)
+        else:
+            print(f"Pillow cannot write {each_format}, skipping it.")
+
+    # names contain a hash of their content, so they can be cached forever and change whenever a portrait does
+    manifest = dict()
+    written = set()
+    for each_file in sorted(source_path.glob("*-*.png")):
+        portrait = each_file.stem
+        with Image.open(each_file) as image:
+            image.load()
+            formats_urls = manifest.setdefault(portrait, dict())
+            for each_format in usable_formats:
+                widths_urls = formats_urls.setdefault(each_format, dict())
+                for each_width in widths:
+                    content = encode(image, min(each_width, image.width), each_format.upper(), quality)
+                    content_hash = hashlib.sha256(content).hexdigest()[:12]
+                    file_name = f"{portrait}-{each_width}.{content_hash}.{each_format}"
+                    derivative = target_path / file_name
+                    if not derivative.is_file():
+                        write_atomically(derivative, content)
+                    written.add(file_name)
+                    widths_urls[str(each_width)] = f"assets/images/portraits/derived/{file_name}"
+
+    for each_file in target_path.iterdir():
+        if each_file.name not in written:
+            each_file.unlink()
+
+    manifest_path = source_path / "derivatives.json"
+    write_atomically(manifest_path, json.dumps(manifest, indent=1).encode())
+    return manifest
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build resized, content-hashed portrait derivatives.")
+    parser.add_argument("--source", default="assets/images/portraits")
+    parser.add_argument("--widths", type=int, nargs="+", default=[160, 320, 512])
+    parser.add_argument("--formats", nargs="+", default=["webp", "avif"])
+    parser.add_argument("--quality", type=int, default=80)
+    arguments = parser.parse_args()
+
+    manifest = build_portraits(
+        arguments.source, widths=tuple(arguments.widths), formats=tuple(arguments.formats), quality=arguments.quality
+    )
+    print(f"Built derivatives for {len(manifest)} portraits.")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,8 @@ import time
 import openai
 import requests
 
+from src.tools.prompt_cache import PromptCache
+
 
 ethnicity_distribution = {
     "German": 80.0,
@@ -69,9 +71,20 @@ class Simplified:
         self._text_kwargs = config.pop("text")
         self._image_kwargs = config.pop("image")
 
+        self._cache = PromptCache.from_config(config.pop("cache", None))
+
     def reply_to_prompt(self, prompt: str, **kwargs: any) -> str:
         text_kwargs = dict(self._text_kwargs)
         text_kwargs.update(kwargs)
+
+        cache_key = None
+        if self._cache is not None:
+            cache_key = PromptCache.key(prompt, text_kwargs)
+            reply = self._cache.get(cache_key)
+            if reply is not None:
+                # entries written by earlier runs may still carry whitespace
+                return reply.strip()
+
         reply = ""
 
         while True:
@@ -80,7 +93,7 @@ class Simplified:
                 completion = self._client.chat.completions.create(messages=messages, **text_kwargs)
                 choice, = completion.choices
                 message = choice.message
-                reply = message.content
+                reply = message.content.strip()
                 break
 
             except Exception as e:
@@ -91,7 +104,10 @@ class Simplified:
                 time.sleep(1)
                 continue
 
-        return reply.strip()
+        if self._cache is not None:
+            self._cache.put(cache_key, reply)
+
+        return reply
 
     def save_image(self, prompt: str, target_path: str, **kwargs: any) -> None:
         image_kwargs = dict(self._image_kwargs)
@@ -1,10 +1,18 @@
+import asyncio
+import collections
 import json
 import os
 import random
 import time
+from typing import Callable, Coroutine
+
 import openai
 import requests
 
+from src.tools.misc import write_atomically
+from src.tools.prompt_cache import PromptCache
+from src.tools.rate_limiter import RateLimiter, backoff, backoff_seconds
+
 ethnicity_distribution = {
     "German": 80.0,
     "Turk": 3.7,
@@ -68,18 +76,30 @@ class Simplified:
         self._text_kwargs = config.pop("text")
         self._image_kwargs = config.pop("image")
 
+        self._cache = PromptCache.from_config(config.pop("cache", None))
+
     def reply_to_prompt(self, prompt: str, **kwargs: any) -> str:
         text_kwargs = dict(self._text_kwargs)
         text_kwargs.update(kwargs)
+
+        cache_key = None
+        if self._cache is not None:
+            cache_key = PromptCache.key(prompt, text_kwargs)
+            reply = self._cache.get(cache_key)
+            if reply is not None:
+                # entries written by earlier runs may still carry whitespace
+                return reply.strip()
+
         reply = ""
 
+        attempt = 0
         while True:
             try:
                 messages = [{"role": "user", "content": prompt}]
                 completion = self._client.chat.completions.create(messages=messages, **text_kwargs)
                 choice, = completion.choices
                 message = choice.message
-                reply = message.content
+                reply = message.content.strip()
                 break
 
             except Exception as e:
@@ -87,35 +107,20 @@ class Simplified:
                 print(f"PROMPT:\n{prompt}\n")
                 print(f"RESPONSE:\n{e}\n")
                 print("retrying...")
-                time.sleep(1)
+                attempt += 1
+                time.sleep(backoff_seconds(attempt))
                 continue
 
+        if self._cache is not None:
+            self._cache.put(cache_key, reply)
+
         return reply
 
-    def save_image(self, prompt: str, target_path: str, **kwargs: any) -> None:
+    def image_url(self, prompt: str, **kwargs: any) -> str:
         image_kwargs = dict(self._image_kwargs)
         image_kwargs.update(kwargs)
-
-        while True:
-            try:
-                response = self._client.images.generate(prompt=prompt, **image_kwargs)
-                image_url = response.data[0].url
-
-                response = requests.get(image_url)
-                response.raise_for_status()
-
-                with open(target_path, mode="wb") as file:
-                    file.write(response.content)
-
-                break
-
-            except Exception as e:
-                print("Image generation failed:\n")
-                print(f"PROMPT:\n{prompt}\n")
-                print(f"RESPONSE:\n{e}\n")
-                print("retrying...")
-                time.sleep(1)
-                continue
+        response = self._client.images.generate(prompt=prompt, **image_kwargs)
+        return response.data[0].url
 
 
 def pick(distributions: dict[str, float]) -> str:
@@ -141,102 +146,219 @@ def simple_person_description() -> str:
     return prompt
 
 
-def save_images(max_number: int = -1) -> None:
-    simple_interface = Simplified()
-
-    with open("inspirations.txt", mode="r") as f:
-        inspirations = tuple(each_word.strip() for each_word in f.readlines())
-
-    description_happy = (
+emotion_descriptions = {
+    "happy": (
         "Their face is illuminated with pure ecstasy, their eyes are sparkling with absolute joy. Their lips are "
         "stretched into a wide, infectious grin revealing gleaming teeth, while their rosy cheeks lift higher, "
         "radiating an unparalleled aura of pure euphoria."
-    )
-    description_anxious = (
+    ),
+    "naive": (
+        "Her wide, glistening eyes seemed perpetually stuck in a child-like state of awe, absorbing every morsel of "
+        "information as indisputable truth. With lips slightly parted, and eyebrows forever pitched in surprise, "
+        "the innocence radiating from her guileless countenance was as ubiquitous as the sunlight at high noon."
+    ),
+    "anxious": (
         "Their eyes dart fervently, reflecting a tempest of irrational fear, their wide pupils swallowed by a vast "
         "void of unease and suspicion. Entrenched lines of worry carve gnarled paths across their pallid face, a "
         "chilling canvas punctuated by taut lips locked in a silent scream of incessant dread."
+    ),
+}
+
+
+def description_prompt(inspiration: str) -> str:
+    return (
+        f"Describe a person, such that two different people could draw a portrait of this person according to your "
+        f"description and it would be obvious that they drew the same person. Come up with the following "
+        f"features:\n"
+        f"\n"
+        f"1. hair style\n"
+        f"2. hair color\n"
+        f"3. eye color\n"
+        f"4. ethnicity\n"
+        f"5. some peculiar feature in their appearance that makes them stand out in a crowd\n"
+        f"\n"
+        f"Respond with a list of short items. Let the description be inspired by your visual idea of "
+        f"\"{inspiration}\" but do not mention \"{inspiration}\" or anything similar in your description."
     )
-    description_naive = (
-        "Her wide, glistening eyes seemed perpetually stuck in a child-like state of awe, absorbing every morsel of "
-        "information as indisputable truth. With lips slightly parted, and eyebrows forever pitched in surprise, "
-        "the innocence radiating from her guileless countenance was as ubiquitous as the sunlight at high noon."
+
+
+def complete_description(reply: str) -> str:
+    gender = pick(gender_distribution)
+    years = pick(age_distribution)
+    return reply.strip() + f"\n\nThe person is {gender} and about {years} old.\n"
+
+
+def portrait_prompt(description: str, emotion: str) -> str:
+    draw_prompt = (
+        f"Create a single colored, comic-style portrait of the person above. The image should use vibrant colors "
+        f"typical of comic art, with clear outlines and minimal shading.\n"
+        f"\n"
+        f"IMPORTANT:\n"
+        f"+ show every single detail mentioned in the description\n"
+        f"+ take care to precisely reflect the mentioned age\n"
+        f"+ show only the person, show them only once, don't show anything else"
     )
+    return (
+            "```\n" +
+            description.strip() + "\n\n" + emotion_descriptions[emotion] + "\n" +
+            "```\n\n" +
+            draw_prompt
+    )
+
 
-    for i, each_inspiration in enumerate(inspirations):
-        if i >= 0 and i >= max_number:
-            break
-
-        print(f"Generating image {i}: {each_inspiration}...")
-        meta_prompt = (
-            f"Describe a person, such that two different people could draw a portrait of this person according to your "
-            f"description and it would be obvious that they drew the same person. Come up with the following "
-            f"features:\n"
-            f"\n"
-            f"1. hair style\n"
-            f"2. hair color\n"
-            f"3. eye color\n"
-            f"4. ethnicity\n"
-            f"5. some peculiar feature in their appearance that makes them stand out in a crowd\n"
-            f"\n"
-            f"Respond with a list of short items. Let the description be inspired by your visual idea of "
-            f"\"{each_inspiration}\" but do not mention \"{each_inspiration}\" or anything similar in your description."
-        )
-
-        draw_prompt = (
-            f"Create a single colored, comic-style portrait of the person above. The image should use vibrant colors "
-            f"typical of comic art, with clear outlines and minimal shading.\n"
-            f"\n"
-            f"IMPORTANT:\n"
-            f"+ show every single detail mentioned in the description\n"
-            f"+ take care to precisely reflect the mentioned age\n"
-            f"+ show only the person, show them only once, don't show anything else"
-        )
-
-        description_file_path = f"faces/person_{i:04d}.txt"
-        if os.path.isfile(description_file_path):
-            with open(description_file_path, mode="r") as f:
-                description = f.read()
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+class PortraitManifest:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        if os.path.isfile(path):
+            with open(path, mode="r") as f:
+                self._state = json.load(f)
         else:
-            description = simple_interface.reply_to_prompt(meta_prompt)
-            gender = pick(gender_distribution)
-            years = pick(age_distribution)
-            description = description.strip() + f"\n\nThe person is {gender} and about {years} old.\n"
-            with open(description_file_path, mode="w") as f:
-                f.write(description)
-
-        file_name_happy = f"faces/person_{i:04d}_happy.png"
-        if not os.path.isfile(file_name_happy):
-            print(f"Generating image of happy person {each_inspiration}...")
-            happy_description = (
-                    "```\n" +
-                    description.strip() + "\n\n" + description_happy + "\n" +
-                    "```\n\n" +
-                    draw_prompt
-            )
-            simple_interface.save_image(happy_description, file_name_happy)
-
-        file_name_naive = f"faces/person_{i:04d}_naive.png"
-        if not os.path.isfile(file_name_naive):
-            print(f"Generating image of naive person {each_inspiration}...")
-            naive_description = (
-                    "```\n" +
-                    description.strip() + "\n\n" + description_naive + "\n" +
-                    "```\n\n" +
-                    draw_prompt
-            )
-            simple_interface.save_image(naive_description, file_name_naive)
-
-        file_name_anxious = f"faces/person_{i:04d}_anxious.png"
-        if not os.path.isfile(file_name_anxious):
-            print(f"Generating image of anxious person {each_inspiration}...")
-            paranoid_description = (
-                    "```\n" +
-                    description.strip() + "\n\n" + description_anxious + "\n" +
-                    "```\n\n" +
-                    draw_prompt
-            )
-            simple_interface.save_image(paranoid_description, file_name_anxious)
+            self._state = dict()
+
+    def get(self, face: int, emotion: str) -> dict[str, any]:
+        return self._state.get(f"{face:04d}_{emotion}", dict())
+
+    def update(self, face: int, emotion: str, **values: any) -> None:
+        self._state.setdefault(f"{face:04d}_{emotion}", dict()).update(values)
+        write_atomically(self.path, json.dumps(self._state, indent=1).encode())
+
+
+async def generate_portraits(
+        simple_interface: Simplified, inspirations: list[str], target_dir: str = "faces",
+        describe_workers: int = 4, draw_workers: int = 4, download_workers: int = 8,
+        images_per_minute: float = 5, max_attempts: int = 6) -> None:
+
+    manifest = PortraitManifest(os.path.join(target_dir, "manifest.json"))
+    image_limiter = RateLimiter(requests_per_minute=images_per_minute, max_concurrency=draw_workers)
+    failures = collections.Counter()
+
+    describe_queue = asyncio.Queue()
+    draw_queue = asyncio.Queue()
+    download_queue = asyncio.Queue()
+    verify_queue = asyncio.Queue()
+
+    # items waiting in or being processed by any stage, a stage hands its item on before it counts as finished
+    in_flight = 0
+    finished = asyncio.Event()
+
+    def submit(queue: asyncio.Queue, item: tuple) -> None:
+        nonlocal in_flight
+        in_flight += 1
+        queue.put_nowait(item)
+
+    def description_path(face: int) -> str:
+        return os.path.join(target_dir, f"person_{face:04d}.txt")
+
+    def portrait_path(face: int, emotion: str) -> str:
+        return os.path.join(target_dir, f"person_{face:04d}_{emotion}.png")
+
+    async def retry(stage: str, face: int, emotion: str, queue: asyncio.Queue, item: tuple, error: Exception) -> None:
+        failures[stage, face, emotion] += 1
+        attempts = failures[stage, face, emotion]
+        manifest.update(face, emotion, error=str(error))
+        if max_attempts <= attempts:
+            print(f"Giving up on {stage} of person {face} ({emotion}): {error}")
+            return
+        await backoff(attempts)
+        submit(queue, item)
+
+    async def describe(face: int, inspiration: str) -> None:
+        reply = await asyncio.to_thread(simple_interface.reply_to_prompt, description_prompt(inspiration))
+        write_atomically(description_path(face), complete_description(reply).encode())
+        for each_emotion in emotion_descriptions:
+            if not os.path.isfile(portrait_path(face, each_emotion)):
+                submit(draw_queue, (face, each_emotion))
+
+    async def draw(face: int, emotion: str) -> None:
+        with open(description_path(face), mode="r") as f:
+            description = f.read()
+        try:
+            async with image_limiter.limit(0):
+                url = await asyncio.to_thread(simple_interface.image_url, portrait_prompt(description, emotion))
+        except Exception as e:
+            await retry("draw", face, emotion, draw_queue, (face, emotion), e)
+            return
+        manifest.update(face, emotion, url=url)
+        submit(download_queue, (face, emotion, url))
+
+    async def download(face: int, emotion: str, url: str) -> None:
+        try:
+            response = await asyncio.to_thread(requests.get, url, timeout=60)
+            response.raise_for_status()
+        except Exception as e:
+            # generated urls expire, the image is drawn again if it cannot be fetched anymore
+            await retry("download", face, emotion, draw_queue, (face, emotion), e)
+            return
+        submit(verify_queue, (face, emotion, response.content))
+
+    async def verify(face: int, emotion: str, content: bytes) -> None:
+        if not content.startswith(_PNG_SIGNATURE):
+            await retry("verify", face, emotion, draw_queue, (face, emotion), ValueError("Download is no PNG."))
+            return
+        write_atomically(portrait_path(face, emotion), content)
+        manifest.update(face, emotion, done=True)
+        print(f"Saved {portrait_path(face, emotion)}.")
+
+    async def work(queue: asyncio.Queue, stage: Callable[..., Coroutine]) -> None:
+        nonlocal in_flight
+        while True:
+            item = await queue.get()
+            try:
+                await stage(*item)
+            except Exception as e:
+                print(f"Stage {stage.__name__} failed for {item}: {e}")
+            finally:
+                in_flight -= 1
+                if 0 >= in_flight:
+                    finished.set()
+
+    # resumes every face from its last completed stage
+    for face, each_inspiration in enumerate(inspirations):
+        if not os.path.isfile(description_path(face)):
+            submit(describe_queue, (face, each_inspiration))
+            continue
+
+        for each_emotion in emotion_descriptions:
+            if os.path.isfile(portrait_path(face, each_emotion)):
+                continue
+            url = manifest.get(face, each_emotion).get("url")
+            if url is None:
+                submit(draw_queue, (face, each_emotion))
+            else:
+                submit(download_queue, (face, each_emotion, url))
+
+    stages = (
+        (describe_queue, describe, describe_workers),
+        (draw_queue, draw, draw_workers),
+        (download_queue, download, download_workers),
+        (verify_queue, verify, 1),
+    )
+    workers = [
+        asyncio.create_task(work(each_queue, each_stage))
+        for each_queue, each_stage, no_workers in stages
+        for _ in range(no_workers)
+    ]
+
+    if 0 < in_flight:
+        await finished.wait()
+
+    for each_worker in workers:
+        each_worker.cancel()
+
+
+def save_images(max_number: int = -1) -> None:
+    simple_interface = Simplified()
+
+    with open("inspirations.txt", mode="r") as f:
+        inspirations = [each_word.strip() for each_word in f.readlines()]
+
+    if 0 <= max_number:
+        inspirations = inspirations[:max_number]
+
+    asyncio.run(generate_portraits(simple_interface, inspirations))
 
     """
     generate 100 descriptions (be inspired by )
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import itertools
+import os
+import pathlib
 from typing import Generator
 
 
@@ -41,6 +43,14 @@ def hex_color_segmentation(lightness: float) -> Generator[str, None, None]:
         yield f"hsl({int(hue * 360)}, {int(saturation * 100)}%, {int(lightness * 100)}%)"
 
 
+def write_atomically(target_path: str | pathlib.Path, content: bytes) -> None:
+    # readers and reruns see either the previous or the complete file, never a partial one
+    temporary_path = f"{target_path}.tmp"
+    with open(temporary_path, mode="wb") as f:
+        f.write(content)
+    os.replace(temporary_path, target_path)
+
+
 def main():
     generator_segmentation = hex_color_segmentation()
 
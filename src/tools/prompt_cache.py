@@ -0,0 +1,122 @@
+# coding=utf-8
+import atexit
+import hashlib
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+
+
+class PromptCache:
+    @staticmethod
+    def key(prompt: str, arguments: dict[str, any]) -> str:
+        # the model is part of the arguments, so replies of different models never mix
+        content = json.dumps({"arguments": arguments, "prompt": prompt}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    @classmethod
+    def from_config(cls, cache_config: dict[str, any] | None) -> "PromptCache | None":
+        # optional, e.g. {"path": "prompt_cache.sqlite", "replay": true} to rerun without requests
+        return None if cache_config is None else cls(**cache_config)
+
+    def __init__(
+            self, path: str = "prompt_cache.sqlite", max_bytes: int = 256 * 1024 * 1024, replay: bool = False,
+            max_pending_uses: int = 1_000) -> None:
+
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        # replay only answers from the cache and never writes, runs fully offline and fails on unknown prompts
+        self.replay = replay
+
+        self.hits = 0
+        self.misses = 0
+
+        # hits only note their access time, it is written along with the next put or once enough have piled up
+        self.max_pending_uses = max_pending_uses
+        self._pending_uses: dict[str, float] = dict()
+
+        if replay:
+            uri = f"{self.path.resolve().as_uri()}?mode=ro"
+            self._connection = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self._connection = sqlite3.connect(self.path.as_posix(), check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS replies "
+                "(key TEXT PRIMARY KEY, reply TEXT NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS replies_used ON replies (used)")
+            self._connection.commit()
+
+        self.current_bytes, = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM replies").fetchone()
+        self._lock = threading.Lock()
+        self._closed = False
+        # access times noted since the last write would otherwise be lost with the process
+        atexit.register(self.close)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._connection.execute("SELECT reply FROM replies WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.replay:
+                    raise KeyError(f"Prompt {key} is not cached.")
+                return None
+
+            self.hits += 1
+            if not self.replay:
+                self._pending_uses[key] = time.time()
+                if self.max_pending_uses <= len(self._pending_uses):
+                    self._write_uses()
+                    self._connection.commit()
+
+            reply, = row
+            return reply
+
+    def _write_uses(self) -> None:
+        # must be called with the lock held, the caller commits
+        if 0 < len(self._pending_uses):
+            self._connection.executemany(
+                "UPDATE replies SET used = ? WHERE key = ?",
+                [(used, each_key) for each_key, used in self._pending_uses.items()]
+            )
+            self._pending_uses.clear()
+
+    def put(self, key: str, reply: str) -> None:
+        if self.replay:
+            return
+
+        size = len(reply.encode())
+        with self._lock:
+            # eviction must see the latest hits
+            self._write_uses()
+            previous = self._connection.execute("SELECT size FROM replies WHERE key = ?", (key,)).fetchone()
+            if previous is not None:
+                self.current_bytes -= previous[0]
+
+            self._connection.execute(
+                "INSERT OR REPLACE INTO replies (key, reply, size, used) VALUES (?, ?, ?, ?)",
+                (key, reply, size, time.time())
+            )
+            self.current_bytes += size
+
+            # least recently used replies go first
+            while self.current_bytes > self.max_bytes:
+                row = self._connection.execute("SELECT key, size FROM replies ORDER BY used LIMIT 1").fetchone()
+                if row is None:
+                    break
+                evicted_key, evicted_size = row
+                self._connection.execute("DELETE FROM replies WHERE key = ?", (evicted_key,))
+                self.current_bytes -= evicted_size
+
+            self._connection.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if not self.replay:
+                self._write_uses()
+                self._connection.commit()
+            self._connection.close()
@@ -0,0 +1,92 @@
+# coding=utf-8
+import asyncio
+import contextlib
+import dataclasses
+import random
+import time
+from typing import AsyncGenerator
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: float | None = None) -> None:
+        if 0 >= per_minute:
+            raise ValueError("Rate must be positive.")
+
+        self.rate = per_minute / 60.
+        # a full minute of budget may be spent at once, just like the providers count it
+        self.capacity = per_minute if capacity is None else capacity
+        self._level = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float = 1.) -> None:
+        # requests larger than the bucket wait until it is full
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if amount <= self._level:
+                    self._level -= amount
+                    return
+                await asyncio.sleep((amount - self._level) / self.rate)
+
+    def adjust(self, amount: float) -> None:
+        # settles the difference between an estimate and the actual usage, the level may become negative
+        self._refill()
+        self._level = min(self.capacity, self._level - amount)
+
+
+@dataclasses.dataclass
+class RequestMetrics:
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    requests: int = 0
+    retries: int = 0
+    cached: int = 0
+    failures: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    items: int = 0
+
+    def items_per_kilotoken(self) -> float:
+        return 1_000 * self.items / max(1, self.prompt_tokens + self.completion_tokens)
+
+    def report(self) -> str:
+        minutes = max(time.monotonic() - self.started, 1e-9) / 60.
+        tokens = self.prompt_tokens + self.completion_tokens
+        return (
+            f"{self.requests} requests ({self.requests / minutes:.1f}/min), {self.cached} cached, "
+            f"{tokens} tokens ({tokens / minutes:.0f}/min), "
+            f"{self.items} items ({self.items / minutes:.1f}/min, {self.items_per_kilotoken():.2f} per 1k tokens), "
+            f"{self.retries} retries, {self.failures} failures"
+        )
+
+
+class RateLimiter:
+    def __init__(
+            self, requests_per_minute: float = 500, tokens_per_minute: float = 150_000, max_concurrency: int = 16
+    ) -> None:
+
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.semaphore = asyncio.BoundedSemaphore(max_concurrency)
+
+    @contextlib.asynccontextmanager
+    async def limit(self, estimated_tokens: int) -> AsyncGenerator[None, None]:
+        async with self.semaphore:
+            await self.requests.acquire()
+            await self.tokens.acquire(estimated_tokens)
+            yield
+
+
+def backoff_seconds(attempt: int, base_seconds: float = 1., max_seconds: float = 60.) -> float:
+    # full jitter keeps concurrent clients from retrying in lockstep
+    return random.uniform(0., min(max_seconds, base_seconds * 2 ** attempt))
+
+
+async def backoff(attempt: int, base_seconds: float = 1., max_seconds: float = 60.) -> None:
+    await asyncio.sleep(backoff_seconds(attempt, base_seconds=base_seconds, max_seconds=max_seconds))
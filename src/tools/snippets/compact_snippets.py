@@ -0,0 +1,30 @@
+# coding=utf-8
+import argparse
+import json
+import time
+
+from src.database.snippet_manager import SnippetManager
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Renumber snippets once removals left too many holes in the id range.")
+    parser.add_argument("--max-hole-ratio", type=float, default=.1)
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    parser.add_argument("--config", default="../../../config.json")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, mode="r") as config_file:
+        config = json.load(config_file)
+
+    snippets_config = config["redis"]["snippets_database"]
+    snippet_database = SnippetManager(snippets_config)
+
+    started = time.time()
+    moved = snippet_database.compact_snippets(
+        max_hole_ratio=arguments.max_hole_ratio, batch_size=arguments.batch_size
+    )
+    print(f"Moved {moved} snippets in {time.time() - started:.1f} seconds.")
+
+
+if __name__ == "__main__":
+    main()
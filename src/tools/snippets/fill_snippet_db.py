@@ -1,23 +1,38 @@
 # coding=utf-8
 import asyncio
+import collections
+import concurrent.futures
 import dataclasses
-
+import itertools
 import json
-import math
+import os
 import pathlib
-import random
-import time
-from typing import Generator
+from typing import Callable, Generator
 
 import pandas
 import bs4
+from loguru import logger
 
+from src.database.snippet_deduplicator import RejectedSnippet
 from src.database.snippet_manager import SnippetManager
 from src.dataobjects import Snippet
-from src.tools.snippets.generate_fake_comments import PromptOpenAI, get_fake_comments
+from src.tools.prompt_cache import PromptCache
+from src.tools.rate_limiter import RateLimiter, backoff
+from src.tools.snippets.ingestion_manifest import IngestionManifest
+from src.tools.snippets.generate_fake_comments import (
+    AdaptiveBatchSize, PromptOpenAI, TRANSIENT_ERRORS, get_fake_comments
+)
+
+
+_SOURCE = "https://www.kaggle.com/datasets/maxmnemo1010/germanyoutubecomments"
+_COLUMNS = ["Comment", "Name", "Time", "Likes", "Reply Count"]
 
 
-def get_snippets(csv_file_path: pathlib.Path) -> Generator[Snippet, None, None]:
+def get_snippets(
+        csv_file_path: pathlib.Path,
+        min_likes: int = 0, min_text: int = 0, max_text: int | None = None,
+        chunk_size: int = 10_000) -> Generator[Snippet, None, None]:
+
     # get name of containing directory
     dir_name = csv_file_path.parent.name
 
@@ -26,49 +41,53 @@ def get_snippets(csv_file_path: pathlib.Path) -> Generator[Snippet, None, None]:
 
     video_name = file_name.split("_")[1].removesuffix(".csv")
 
-    csv_data = pandas.read_csv(csv_file_path.as_posix())
-    for i, each_row in csv_data.iterrows():
-        comment_raw = each_row["Comment"]
-        if not isinstance(comment_raw, str):
-            continue
-        soup = bs4.BeautifulSoup(comment_raw, "html.parser")
-        comment = soup.get_text().strip()
-
-        name_raw = each_row["Name"]
-        if not isinstance(name_raw, str):
-            continue
-        name = name_raw.strip()
-
-        time_str_raw = each_row["Time"]
-        if not isinstance(time_str_raw, str):
-            continue
-        time_str = time_str_raw.strip()
-
-        likes = each_row["Likes"]
-        reply_count = each_row["Reply Count"]
+    for each_chunk in pandas.read_csv(csv_file_path.as_posix(), usecols=_COLUMNS, chunksize=chunk_size):
+        # parsing html never makes a comment longer, so rows can be dropped by their raw length before parsing
+        comments = each_chunk["Comment"]
+        valid = comments.map(lambda value: isinstance(value, str))
+        valid &= each_chunk["Name"].map(lambda value: isinstance(value, str))
+        valid &= each_chunk["Time"].map(lambda value: isinstance(value, str))
+        valid &= min_likes <= each_chunk["Likes"]
+
+        raw_lengths = comments.where(valid, "").str.strip().str.len()
+        valid &= min_text <= raw_lengths
+
+        has_markup = comments.where(valid, "").str.contains("[<&]", regex=True)
+        if max_text is not None:
+            # without markup the raw length is the final length
+            valid &= has_markup | (raw_lengths <= max_text)
+
+        selected = each_chunk[valid]
+        for comment_raw, name_raw, time_str_raw, likes, reply_count, markup in zip(
+                selected["Comment"], selected["Name"], selected["Time"],
+                selected["Likes"], selected["Reply Count"], has_markup[valid]):
+
+            if markup:
+                soup = bs4.BeautifulSoup(comment_raw, "html.parser")
+                comment = soup.get_text().strip()
+                if len(comment) < min_text or max_text is not None and max_text < len(comment):
+                    continue
+            else:
+                comment = comment_raw.strip()
 
-        metadata_dict = {
-            "likes": int(likes),
-            "reply_count": int(reply_count),
-            "time": time_str,
-            "channel": dir_name,
-            "video": video_name,
-            "commentator": name
-        }
-        metadata = tuple(tuple(each_item) for each_item in metadata_dict.items())
+            metadata_dict = {
+                "likes": int(likes),
+                "reply_count": int(reply_count),
+                "time": time_str_raw.strip(),
+                "channel": dir_name,
+                "video": video_name,
+                "commentator": name_raw.strip()
+            }
+            metadata = tuple(tuple(each_item) for each_item in metadata_dict.items())
 
-        yield Snippet(
-            comment,
-            "https://www.kaggle.com/datasets/maxmnemo1010/germanyoutubecomments",
-            False, metadata)
+            yield Snippet(comment, _SOURCE, False, metadata)
 
 
-def snippets_from_file_system(
-        path_str: str,
-        min_likes: int = 5, min_text: int = 250, max_text: int = 1_000) -> Generator[Snippet, None, None]:
+def _read_snippets(csv_file_path: pathlib.Path, min_likes: int, min_text: int, max_text: int) -> list[Snippet]:
+    return list(get_snippets(csv_file_path, min_likes=min_likes, min_text=min_text, max_text=max_text))
 
-    path = pathlib.Path(path_str)
 
+def _csv_files(path: pathlib.Path) -> Generator[pathlib.Path, None, None]:
     for each_dir in sorted(path.iterdir()):
         if not each_dir.is_dir():
             continue
@@ -80,13 +99,43 @@ def snippets_from_file_system(
             if not each_file.name.endswith(".csv"):
                 continue
 
-            for each_snippet in get_snippets(each_file):
-                each_likes = each_snippet.metadata[0][1]
-                len_text = len(each_snippet.text)
-                if each_likes < min_likes or len_text < min_text or max_text < len_text:
-                    continue
+            yield each_file
+
+
+def snippet_files_from_file_system(
+        path_str: str,
+        min_likes: int = 5, min_text: int = 250, max_text: int = 1_000,
+        processes: int | None = None, skip_file: Callable[[pathlib.Path], bool] | None = None
+) -> Generator[tuple[pathlib.Path, list[Snippet]], None, None]:
+
+    path = pathlib.Path(path_str)
+    max_workers = processes or os.cpu_count() or 1
+
+    # files are parsed in parallel but yielded in order, with a bounded number of parsed files held in memory
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        for each_file in _csv_files(path):
+            if skip_file is not None and skip_file(each_file):
+                continue
+
+            each_future = executor.submit(_read_snippets, each_file, min_likes, min_text, max_text)
+            pending.append((each_file, each_future))
+            if 2 * max_workers <= len(pending):
+                file_path, future = pending.popleft()
+                yield file_path, future.result()
+
+        while 0 < len(pending):
+            file_path, future = pending.popleft()
+            yield file_path, future.result()
 
-                yield each_snippet
+
+def snippets_from_file_system(
+        path_str: str,
+        min_likes: int = 5, min_text: int = 250, max_text: int = 1_000,
+        processes: int | None = None) -> Generator[Snippet, None, None]:
+
+    for _, each_snippets in snippet_files_from_file_system(path_str, min_likes, min_text, max_text, processes):
+        yield from each_snippets
 
 
 async def main() -> None:
@@ -98,71 +147,151 @@ async def main() -> None:
 
     snippet_database = SnippetManager(snippets_config)
 
-    no_auth_comments = await add_authentic_comments(snippet_database)
+    # a rerun skips everything the manifest records as stored
+    manifest = IngestionManifest()
+
+    no_auth_comments = await add_authentic_comments(snippet_database, manifest)
 
     openai_config = config["openai"]
-    prompt_openai = PromptOpenAI(openai_config)
+    limits = openai_config.get("limits", dict())
+    rate_limiter = RateLimiter(**limits)
+    cache = PromptCache.from_config(openai_config.get("cache"))
+    prompt_openai = PromptOpenAI(openai_config, rate_limiter=rate_limiter, cache=cache)
+
+    batching = AdaptiveBatchSize(**openai_config.get("batching", dict()))
+    await generate_fake_comments(
+        prompt_openai, snippet_database, manifest, batching, no_auth_comments,
+        max_concurrency=limits.get("max_concurrency", 16)
+    )
+
+
+async def generate_fake_comments(
+        prompt_openai: PromptOpenAI, snippet_database: SnippetManager, manifest: IngestionManifest,
+        batching: AdaptiveBatchSize, target_count: int,
+        max_concurrency: int = 16, report_seconds: float = 10.
+) -> None:
+
+    # the workers only wait for the rate limiter, so the provider's limits are the only bottleneck
+    remaining = (i for i in itertools.count() if not manifest.is_batch_done(i))
 
-    # todo: request in parallel
+    async def worker() -> None:
+        while manifest.generated_snippets() < target_count:
+            batch_id = next(remaining)
+            snippet_ids = await add_fake_comments(prompt_openai, snippet_database, batching)
+            manifest.commit_batch(batch_id, snippet_ids)
 
-    iterations = int(math.ceil(no_auth_comments / 3))
-    for i in range(iterations):
-        print(f"Generating fake comments {i + 1} / {iterations}")
-        await add_fake_comments(prompt_openai, snippet_database, no_auth_comments)
+    async def reporter() -> None:
+        while True:
+            await asyncio.sleep(report_seconds)
+            print(
+                f"Generating fake comments: {prompt_openai.metrics.report()}, {batching.report()}, "
+                f"{manifest.rows_per_second():.1f} rows per second"
+            )
+
+    reporting = asyncio.create_task(reporter())
+    try:
+        await asyncio.gather(*(worker() for _ in range(max_concurrency)))
+    finally:
+        reporting.cancel()
+
+    print(f"Generated fake comments: {prompt_openai.metrics.report()}, {batching.report()}")
 
 
 async def add_fake_comments(
-        prompt_openai: PromptOpenAI, snippet_database: SnippetManager, auth_snippet_count: int, batch_size: int = 20
-) -> None:
+        prompt_openai: PromptOpenAI, snippet_database: SnippetManager, batching: AdaptiveBatchSize,
+        max_attempts: int = 3) -> list[int]:
     no_examples = 5
     example_snippets = tuple(
-        snippet_database.get_snippet(random.randint(0, auth_snippet_count - 1))
-        for _ in range(no_examples)
+        snippet_database.get_snippet(each_id)
+        for each_id in snippet_database.get_random_snippet_ids(no_examples, is_bot=False)
     )
 
     example_content = list()
     for each_snippet in example_snippets:
         d = dataclasses.asdict(each_snippet)
+        # token offsets are computed at ingestion, they are no example for the model
+        del d["tokens"]
         d_str = json.dumps(d)
         example_content.append(d_str)
 
+    attempt = 0
     while True:
         try:
-            fake_comments = await get_fake_comments(prompt_openai, example_content, output_comments=3)
+            output_comments = batching.next_size()
+            fake_comments, completion_tokens = await get_fake_comments(
+                prompt_openai, example_content, output_comments=output_comments
+            )
             generated_snippets = list()
 
-            for each_fake_comment in fake_comments:
-                json_dict = json.loads(each_fake_comment)
-                json_dict["is_bot"] = True
-                each_snippet = Snippet(**json_dict)
+            # a broken object only costs itself, the rest of the reply is kept
+            for each_fake_comment in fake_comments[:output_comments]:
+                try:
+                    json_dict = json.loads(each_fake_comment)
+                    json_dict["is_bot"] = True
+                    json_dict.pop("tokens", None)
+                    each_snippet = Snippet(**json_dict)
+                except (ValueError, TypeError) as e:
+                    logger.warning(f"Skipping malformed fake comment: {e}")
+                    continue
                 generated_snippets.append(each_snippet)
 
-            for each_snippet in generated_snippets:
-                snippet_database.set_snippet(
-                    each_snippet.text,
-                    each_snippet.source,
-                    True,
-                    dict(each_snippet.metadata)
-                )
-
-            break
-
-        except Exception as e:
-            print(e)
-            time.sleep(1)
-
-
-async def add_authentic_comments(snippet_database: SnippetManager) -> int:
-    path = "/home/mark/nas/data/kaggle/archive (11)/YouTube Deutschland"
-    snippets_added = 0
-    for each_snippet in snippets_from_file_system(path):
-        snippet_database.set_snippet(
-            each_snippet.text,
-            each_snippet.source,
-            each_snippet.is_bot,
-            dict(each_snippet.metadata)
-        )
-        snippets_added += 1
+            batching.record(output_comments, len(fake_comments), len(generated_snippets), completion_tokens)
+
+            rejected = list()
+            snippet_ids = await asyncio.to_thread(
+                snippet_database.set_snippets, generated_snippets, rejected=rejected
+            )
+            write_rejection_report(rejected)
+            prompt_openai.metrics.items += len(snippet_ids)
+            return snippet_ids
+
+        except TRANSIENT_ERRORS as e:
+            # everything else is a bug or a rejected request, retrying would only repeat it
+            attempt += 1
+            if max_attempts <= attempt:
+                raise
+            logger.warning(f"Generating fake comments failed, attempt {attempt} of {max_attempts}: {e}")
+            await backoff(attempt)
+
+
+def write_rejection_report(rejected: list[RejectedSnippet], report_path: str = "rejected_snippets.jsonl") -> None:
+    if len(rejected) < 1:
+        return
+
+    with open(report_path, mode="a") as report_file:
+        for each_rejection in rejected:
+            each_entry = {
+                "text": each_rejection.snippet.text,
+                "source": each_rejection.snippet.source,
+                "is_bot": each_rejection.snippet.is_bot,
+                "duplicate_of": each_rejection.duplicate_of,
+                "similarity": each_rejection.similarity
+            }
+            report_file.write(json.dumps(each_entry) + "\n")
+
+    print(f"Rejected {len(rejected)} duplicate snippets, see {report_path}.")
+
+
+async def add_authentic_comments(
+        snippet_database: SnippetManager, manifest: IngestionManifest, batch_size: int = 1_000,
+        path: str = "/home/mark/nas/data/kaggle/archive (11)/YouTube Deutschland") -> int:
+
+    rejected = list()
+    for each_file, each_snippets in snippet_files_from_file_system(path, skip_file=manifest.is_file_done):
+        # continues after the last batch committed by a previous run
+        offset = manifest.file_offset(each_file)
+        while True:
+            batch = each_snippets[offset:offset + batch_size]
+            snippet_ids = snippet_database.set_snippets(batch, batch_size=batch_size, rejected=rejected)
+            offset += len(batch)
+            manifest.commit_rows(each_file, offset, snippet_ids, offset >= len(each_snippets))
+            if offset >= len(each_snippets):
+                break
+
+        print(f"Added snippets from {each_file.name}, {manifest.rows_per_second():.0f} rows per second.")
+
+    write_rejection_report(rejected)
+    snippets_added = manifest.stored_snippets()
     print(f"Added {snippets_added} snippets.")
     return snippets_added
 
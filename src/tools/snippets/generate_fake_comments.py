@@ -1,10 +1,17 @@
+import asyncio
 import re
-import time
 from typing import Generator, Collection
 
 import openai
 from loguru import logger
 
+from src.tools.prompt_cache import PromptCache
+from src.tools.rate_limiter import RateLimiter, RequestMetrics, backoff
+
+
+# errors that may pass by themselves, timeouts are connection errors as well
+TRANSIENT_ERRORS = openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError
+
 
 class PromptOpenAI:
     @staticmethod
@@ -20,42 +27,94 @@ class PromptOpenAI:
             start += max_len - overlap
             end += max_len - overlap
 
-    def __init__(self, config: dict[str, any]) -> None:
-        self._client = openai.AsyncOpenAI(api_key=config["key"])
+    def __init__(
+            self, config: dict[str, any],
+            rate_limiter: RateLimiter | None = None, metrics: RequestMetrics | None = None,
+            cache: PromptCache | None = None) -> None:
+
+        # retries are handled here, so that they respect the rate limits and back off with jitter
+        self._client = openai.AsyncOpenAI(api_key=config["key"], base_url=config.get("base_url"), max_retries=0)
         self._config = config["parameters"]
+        self.max_attempts = config.get("max_attempts", 8)
+
+        self.rate_limiter = rate_limiter
+        self.metrics = RequestMetrics() if metrics is None else metrics
+        self.cache = cache
+
+    def _estimate_tokens(self, prompt: str, arguments: dict[str, any]) -> int:
+        # about four characters per token, plus whatever the completion may take
+        return len(prompt) // 4 + int(arguments.get("max_tokens") or 1_000)
+
+    async def summarize(
+            self, text: str, max_len_input: int = 10_000, max_len_summary: int = 500,
+            fan_in: int = 4, max_concurrency: int = 8) -> str:
 
-    async def summarize(self, text: str, max_len_input: int = 10_000, max_len_summary: int = 500) -> str:
         len_text = len(text)
         if len_text < max_len_summary:
             return text
 
-        summaries = list()
-        for each_chunk in self.chunk_text(text, max_len=max_len_input):
-            summary = await self.summarize(each_chunk, max_len_input=max_len_input, max_len_summary=max_len_summary)
-            summaries.append(summary)
-        text = "\n".join(summaries)
+        if max_len_input < fan_in * max_len_summary:
+            raise ValueError("`fan_in` summaries must fit into `max_len_input`.")
 
-        prompt = (
-            f"```text\n"
-            f"{text}\n"
-            f"```\n"
-            f"\n"
-            f"Summarize the text above in about {max_len_summary} characters keeping its original language."
-        )
-        response = await self.reply_to_prompt(prompt)
-        return response
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def summarize_chunk(chunk: str) -> str:
+            prompt = (
+                f"```text\n"
+                f"{chunk}\n"
+                f"```\n"
+                f"\n"
+                f"Summarize the text above in about {max_len_summary} characters keeping its original language."
+            )
+            async with semaphore:
+                return await self.reply_to_prompt(prompt)
+
+        # chunks and groups only depend on the text, so identical prompts are sent again on every run
+        summaries = await asyncio.gather(*(
+            summarize_chunk(each_chunk) for each_chunk in self.chunk_text(text, max_len=max_len_input)
+        ))
+
+        # each level reduces `fan_in` summaries to one, the depth grows logarithmically with the text length
+        while 1 < len(summaries):
+            groups = ("\n".join(summaries[i:i + fan_in]) for i in range(0, len(summaries), fan_in))
+            summaries = await asyncio.gather(*(summarize_chunk(each_group) for each_group in groups))
+
+        summary, = summaries
+        return summary
 
     async def reply_to_prompt(self, prompt: str, **kwargs: any) -> str:
+        reply, _ = await self.reply_with_usage(prompt, **kwargs)
+        return reply
+
+    async def reply_with_usage(self, prompt: str, **kwargs: any) -> tuple[str, int | None]:
+        # completion tokens of this very request, None for cached replies and providers without usage
         logger.info(prompt)
 
         arguments = dict(self._config)
         arguments.update(kwargs)
 
-        reply = ""
+        cache_key = None
+        if self.cache is not None:
+            cache_key = PromptCache.key(prompt, arguments)
+            # the cache is an sqlite file, it is never touched from the event loop
+            reply = await asyncio.to_thread(self.cache.get, cache_key)
+            if reply is not None:
+                self.metrics.cached += 1
+                logger.info(reply)
+                return reply.strip(), None
+
+        estimated_tokens = self._estimate_tokens(prompt, arguments)
+        messages = [{"role": "user", "content": prompt}]
+
+        attempt = 0
         while True:
             try:
-                messages = [{"role": "user", "content": prompt}]
-                response = await self._client.chat.completions.create(messages=messages, **arguments)
+                if self.rate_limiter is None:
+                    response = await self._client.chat.completions.create(messages=messages, **arguments)
+                else:
+                    async with self.rate_limiter.limit(estimated_tokens):
+                        response = await self._client.chat.completions.create(messages=messages, **arguments)
+
                 choice, = response.choices
                 message = choice.message
                 reply = message.content
@@ -63,11 +122,29 @@ class PromptOpenAI:
 
             except Exception as e:
                 logger.error(e)
-                time.sleep(1)
-                continue
+                attempt += 1
+                if self.max_attempts <= attempt:
+                    self.metrics.failures += 1
+                    raise
+
+                self.metrics.retries += 1
+                await backoff(attempt)
+
+        self.metrics.requests += 1
+        usage = response.usage
+        completion_tokens = None
+        if usage is not None:
+            completion_tokens = usage.completion_tokens
+            self.metrics.prompt_tokens += usage.prompt_tokens
+            self.metrics.completion_tokens += usage.completion_tokens
+            if self.rate_limiter is not None:
+                self.rate_limiter.tokens.adjust(usage.total_tokens - estimated_tokens)
+
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, cache_key, reply)
 
         logger.info(reply)
-        return reply.strip()
+        return reply.strip(), completion_tokens
 
 
 def extract_code_blocks(text: str, code_type: str = "") -> tuple[str, ...]:
@@ -87,13 +164,66 @@ def extract_code_blocks(text: str, code_type: str = "") -> tuple[str, ...]:
     return tuple(match.strip() for match in matches)
 
 
+class AdaptiveBatchSize:
+    def __init__(
+            self, max_tokens: int = 4_096, min_comments: int = 1, max_comments: int = 20,
+            initial_comments: int = 3, max_failure_rate: float = .2, smoothing: float = .2) -> None:
+
+        # the examples are sent with every request, so larger batches spend fewer tokens per fake
+        self.max_tokens = max_tokens
+        self.min_comments = min_comments
+        self.max_comments = max_comments
+        self.max_failure_rate = max_failure_rate
+        self.smoothing = smoothing
+
+        self.size = initial_comments
+        self.comment_tokens: float | None = None
+        self.failure_rate = 0.
+
+        self.requested = 0
+        self.parsed = 0
+
+    def next_size(self) -> int:
+        size = self.size
+        if self.comment_tokens is not None:
+            # all requested comments have to fit into the completion
+            size = min(size, int(self.max_tokens / self.comment_tokens))
+        return max(self.min_comments, min(self.max_comments, size))
+
+    def record(self, requested: int, no_returned: int, no_parsed: int, completion_tokens: int | None) -> None:
+        self.requested += requested
+        self.parsed += no_parsed
+
+        failures = max(0, requested - no_parsed) / requested
+        self.failure_rate += self.smoothing * (failures - self.failure_rate)
+
+        if completion_tokens is not None and 0 < no_returned:
+            # broken comments and the text around the code blocks take up the completion just the same
+            tokens = completion_tokens / no_returned
+            if self.comment_tokens is None:
+                self.comment_tokens = tokens
+            else:
+                self.comment_tokens += self.smoothing * (tokens - self.comment_tokens)
+
+        # grows slowly while the model keeps up and backs off quickly when it starts to break the format
+        if self.max_failure_rate < self.failure_rate:
+            self.size = max(self.min_comments, self.size // 2)
+        else:
+            self.size = min(self.max_comments, self.size + 1)
+
+    def report(self) -> str:
+        return (
+            f"{self.next_size()} comments per request, {self.parsed} of {self.requested} parsed, "
+            f"failure rate {self.failure_rate:.2f}"
+        )
+
+
 async def get_fake_comments(
         open_ai: PromptOpenAI, comments: Collection[str],
-        output_comments: int = 3) -> Collection[str]:
+        output_comments: int = 3) -> tuple[tuple[str, ...], int | None]:
 
-    len_comments = len(comments)
-    if output_comments >= len_comments:
-        raise ValueError(f"`output_comments` must be smaller than the number of `comments`.")
+    if 0 >= output_comments:
+        raise ValueError(f"`output_comments` must be positive.")
 
     fenced_examples = (
         (
@@ -130,6 +260,6 @@ async def get_fake_comments(
         f"[...]"
     )
 
-    open_ai_response = await open_ai.reply_to_prompt(prompt)
+    open_ai_response, completion_tokens = await open_ai.reply_with_usage(prompt)
     fake_comments = extract_code_blocks(open_ai_response, code_type="json")
-    return fake_comments
+    return fake_comments, completion_tokens
@@ -0,0 +1,76 @@
+# coding=utf-8
+import json
+import pathlib
+import time
+
+from src.tools.misc import write_atomically
+
+
+class IngestionManifest:
+    @staticmethod
+    def _id_ranges(snippet_ids: list[int], ranges: list[list[int]] | None = None) -> list[list[int]]:
+        # ids are reserved in contiguous blocks, so a few ranges cover a whole run
+        ranges = list() if ranges is None else ranges
+        for each_id in sorted(snippet_ids):
+            if 0 < len(ranges) and ranges[-1][1] == each_id:
+                ranges[-1][1] = each_id + 1
+            else:
+                ranges.append([each_id, each_id + 1])
+        return ranges
+
+    def __init__(self, path: str = "ingestion_manifest.json") -> None:
+        self.path = pathlib.Path(path)
+        if self.path.is_file():
+            with self.path.open(mode="r") as manifest_file:
+                self._state = json.load(manifest_file)
+        else:
+            self._state = {"files": dict(), "batches": dict()}
+
+        self._started = time.monotonic()
+        self._rows = 0
+
+    def _save(self) -> None:
+        # replaced atomically, so a crash leaves the previous checkpoint intact
+        write_atomically(self.path, json.dumps(self._state).encode())
+
+    # offsets count the rows of a file that passed the filters, the filters must not change between runs
+    def file_offset(self, file_path: pathlib.Path) -> int:
+        entry = self._state["files"].get(file_path.as_posix())
+        return 0 if entry is None else entry["offset"]
+
+    def is_file_done(self, file_path: pathlib.Path) -> bool:
+        entry = self._state["files"].get(file_path.as_posix())
+        return entry is not None and entry["done"]
+
+    def commit_rows(self, file_path: pathlib.Path, offset: int, snippet_ids: list[int], done: bool) -> None:
+        entry = self._state["files"].setdefault(file_path.as_posix(), {"offset": 0, "done": False, "ids": list()})
+        self._rows += offset - entry["offset"]
+        entry["offset"] = offset
+        entry["done"] = done
+        entry["ids"] = IngestionManifest._id_ranges(snippet_ids, entry["ids"])
+        self._save()
+
+    def stored_snippets(self) -> int:
+        return sum(
+            each_to - each_from
+            for each_entry in self._state["files"].values()
+            for each_from, each_to in each_entry["ids"]
+        )
+
+    def is_batch_done(self, batch_id: int) -> bool:
+        return str(batch_id) in self._state["batches"]
+
+    def commit_batch(self, batch_id: int, snippet_ids: list[int]) -> None:
+        self._state["batches"][str(batch_id)] = IngestionManifest._id_ranges(snippet_ids)
+        self._rows += len(snippet_ids)
+        self._save()
+
+    def generated_snippets(self) -> int:
+        return sum(
+            each_to - each_from
+            for each_ranges in self._state["batches"].values()
+            for each_from, each_to in each_ranges
+        )
+
+    def rows_per_second(self) -> float:
+        return self._rows / max(time.monotonic() - self._started, 1e-9)
@@ -0,0 +1,37 @@
+# coding=utf-8
+import argparse
+import json
+import time
+
+from src.database.snippet_manager import SnippetManager
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Re-encode all stored snippets with another codec.")
+    parser.add_argument("codec", help="target codec, e.g. plain, packed or zlib")
+    parser.add_argument("--batch-size", type=int, default=1_000)
+    parser.add_argument("--train-dictionary", action="store_true", help="train a new zlib dictionary first")
+    parser.add_argument("--rebuild-indexes", action="store_true", help="re-index live snippets by class and metadata")
+    parser.add_argument("--config", default="../../../config.json")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, mode="r") as config_file:
+        config = json.load(config_file)
+
+    snippets_config = config["redis"]["snippets_database"]
+    snippet_database = SnippetManager(snippets_config, codec=arguments.codec)
+
+    if arguments.train_dictionary:
+        snippet_database.train_dictionary()
+
+    started = time.time()
+    migrated = snippet_database.migrate_snippets(arguments.codec, batch_size=arguments.batch_size)
+    print(f"Migrated {migrated} snippets in {time.time() - started:.1f} seconds.")
+
+    if arguments.rebuild_indexes:
+        no_bots, no_humans = snippet_database.rebuild_indexes(batch_size=arguments.batch_size)
+        print(f"Indexed {no_bots} bot and {no_humans} human snippets.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+# coding=utf-8
+import argparse
+import asyncio
+import datetime
+import json
+
+from loguru import logger
+
+from src.database.snippet_manager import SnippetManager
+from src.tools.prompt_cache import PromptCache
+from src.tools.rate_limiter import RateLimiter
+from src.tools.snippets.fill_snippet_db import add_fake_comments
+from src.tools.snippets.generate_fake_comments import AdaptiveBatchSize, PromptOpenAI
+
+
+class SnippetReplenisher:
+    def __init__(
+            self, snippet_database: SnippetManager, prompt_openai: PromptOpenAI, batching: AdaptiveBatchSize,
+            bot_ratio: float = .5, fakes_per_draw: float = .1, max_pending_jobs: int = 16,
+            max_concurrency: int = 4, daily_token_budget: int = 1_000_000, job_token_estimate: int = 4_000,
+            check_seconds: float = 60.) -> None:
+
+        if not 0. <= bot_ratio < 1.:
+            raise ValueError("Bot ratio must be at least 0 and smaller than 1.")
+
+        self.snippet_database = snippet_database
+        self.redis = snippet_database.redis
+        self.prompt_openai = prompt_openai
+        self.batching = batching
+
+        self.bot_ratio = bot_ratio
+        # share of drawn snippets that is generated anew, so that long-time players keep seeing fresh fakes
+        self.fakes_per_draw = fakes_per_draw
+        self.max_pending_jobs = max_pending_jobs
+        self.max_concurrency = max_concurrency
+        self.daily_token_budget = daily_token_budget
+        # reserved before every job and settled with the reported usage afterwards
+        self.job_token_estimate = job_token_estimate
+        self.check_seconds = check_seconds
+
+        self._owed_fakes = 0.
+        # tokens charged to the budget by this process, reported usage plus the reservations of running jobs
+        self._tokens_charged = 0
+        self._tokens_reserved = 0
+
+    def _budget_key(self) -> str:
+        return f"snippet_jobs:tokens:{datetime.date.today().isoformat()}"
+
+    def _budget_left(self) -> bool:
+        return int(self.redis.get(self._budget_key()) or 0) < self.daily_token_budget
+
+    def _plan_fakes(self, statistics: dict[str, int], drawn_since: int) -> int:
+        # fakes missing for the target ratio plus the share owed for consumption
+        bots, humans = statistics["bots"], statistics["humans"]
+        missing = max(0., self.bot_ratio * (bots + humans) - bots) / (1. - self.bot_ratio)
+        self._owed_fakes += drawn_since * self.fakes_per_draw
+        return int(missing + self._owed_fakes)
+
+    def enqueue_jobs(self, no_fakes: int) -> int:
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.llen("snippet_jobs")
+            pipe.llen("snippet_jobs:processing")
+            no_pending = sum(pipe.execute())
+
+        # every job yields about one batch, the queue never grows beyond what the workers can take soon
+        queued_fakes = no_pending * self.batching.next_size()
+        no_jobs = min(
+            self.max_pending_jobs - no_pending,
+            -(-max(0, no_fakes - queued_fakes) // self.batching.next_size())
+        )
+        if 0 >= no_jobs:
+            return 0
+
+        job_id = self.redis.incrby("snippet_jobs:counter", no_jobs)
+        jobs = [json.dumps({"job_id": each_id, "kind": "fake"}) for each_id in range(job_id - no_jobs, job_id)]
+        self.redis.rpush("snippet_jobs", *jobs)
+        return no_jobs
+
+    def _charge_budget(self, tokens: int) -> int:
+        with self.redis.pipeline() as pipe:
+            pipe.incrby(self._budget_key(), tokens)
+            pipe.expire(self._budget_key(), 2 * 24 * 60 * 60)
+            spent, _ = pipe.execute()
+        self._tokens_charged += tokens
+        return spent
+
+    def _spend_budget(self) -> None:
+        metrics = self.prompt_openai.metrics
+        tokens = metrics.prompt_tokens + metrics.completion_tokens + self._tokens_reserved
+        self._charge_budget(tokens - self._tokens_charged)
+
+    def _reserve_budget(self) -> bool:
+        # the budget is shared through redis, so concurrent workers cannot all start on the last tokens
+        if self.daily_token_budget < self._charge_budget(self.job_token_estimate):
+            self._charge_budget(-self.job_token_estimate)
+            return False
+        self._tokens_reserved += self.job_token_estimate
+        return True
+
+    def _release_budget(self) -> None:
+        self._tokens_reserved -= self.job_token_estimate
+        self._spend_budget()
+
+    async def monitor(self) -> None:
+        drawn_before = None
+        while True:
+            self._spend_budget()
+            statistics = self.snippet_database.get_statistics()
+            drawn_since = 0 if drawn_before is None else statistics["drawn"] - drawn_before
+            drawn_before = statistics["drawn"]
+
+            no_fakes = self._plan_fakes(statistics, drawn_since)
+            no_jobs = self.enqueue_jobs(no_fakes) if self._budget_left() else 0
+            logger.info(
+                f"{statistics['bots']} bot and {statistics['humans']} human snippets, {drawn_since} drawn, "
+                f"{no_fakes} fakes planned, {no_jobs} jobs queued. {self.prompt_openai.metrics.report()}"
+            )
+            await asyncio.sleep(self.check_seconds)
+
+    async def work(self) -> None:
+        while True:
+            if not self._reserve_budget():
+                await asyncio.sleep(self.check_seconds)
+                continue
+
+            try:
+                # a job stays in the processing list until it is done, so a crashed worker loses nothing
+                job = await asyncio.to_thread(
+                    self.redis.blmove, "snippet_jobs", "snippet_jobs:processing", self.check_seconds, "LEFT", "RIGHT"
+                )
+                if job is None:
+                    continue
+
+                snippet_ids = await add_fake_comments(self.prompt_openai, self.snippet_database, self.batching)
+                self.redis.lrem("snippet_jobs:processing", 1, job)
+                self._owed_fakes = max(0., self._owed_fakes - len(snippet_ids))
+
+            finally:
+                self._release_budget()
+
+    def requeue_unfinished_jobs(self) -> int:
+        # only one replenisher may run, everything still processing belongs to a previous run
+        no_jobs = 0
+        while self.redis.lmove("snippet_jobs:processing", "snippet_jobs", "RIGHT", "LEFT") is not None:
+            no_jobs += 1
+        return no_jobs
+
+    async def run(self) -> None:
+        no_jobs = self.requeue_unfinished_jobs()
+        if 0 < no_jobs:
+            logger.info(f"Requeued {no_jobs} unfinished jobs.")
+
+        await asyncio.gather(self.monitor(), *(self.work() for _ in range(self.max_concurrency)))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Keep generating fake snippets as players consume the corpus.")
+    parser.add_argument("--config", default="../../../config.json")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, mode="r") as config_file:
+        config = json.load(config_file)
+
+    snippets_config = config["redis"]["snippets_database"]
+    snippet_database = SnippetManager(snippets_config)
+
+    # point `base_url` to `stub_openai_server.py` to run without the provider
+    openai_config = config["openai"]
+    prompt_openai = PromptOpenAI(
+        openai_config,
+        rate_limiter=RateLimiter(**openai_config.get("limits", dict())),
+        cache=PromptCache.from_config(openai_config.get("cache"))
+    )
+    batching = AdaptiveBatchSize(**openai_config.get("batching", dict()))
+
+    replenisher = SnippetReplenisher(snippet_database, prompt_openai, batching, **config.get("replenishment", dict()))
+    asyncio.run(replenisher.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# coding=utf-8
+import argparse
+import collections
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# imitates the chat completions endpoint, point `base_url` in the openai config to http://localhost:<port>/v1
+class StubCompletionsHandler(BaseHTTPRequestHandler):
+    latency_seconds = 1.
+    requests_per_minute = 500
+    _request_times = collections.deque()
+    _lock = threading.Lock()
+
+    def _rate_limited(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while 0 < len(self._request_times) and self._request_times[0] < now - 60.:
+                self._request_times.popleft()
+            if self.requests_per_minute <= len(self._request_times):
+                return True
+            self._request_times.append(now)
+            return False
+
+    def _send_json(self, status: int, content: dict[str, any]) -> None:
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length))
+
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}."}})
+            return
+
+        if self._rate_limited():
+            self._send_json(429, {"error": {"message": "Rate limit reached.", "type": "requests"}})
+            return
+
+        time.sleep(random.uniform(.5, 1.5) * self.latency_seconds)
+
+        prompt = request["messages"][-1]["content"]
+        examples = list()
+        for each_block in re.findall(r"```json\n(.*?)\n```", prompt, re.DOTALL):
+            # the prompt also shows placeholders for the expected format
+            try:
+                examples.append(json.loads(each_block))
+            except ValueError:
+                continue
+
+        requested = re.search(r"Generate (\d+) JSON objects", prompt)
+        no_objects = 3 if requested is None else int(requested.group(1))
+        blocks = list()
+        for each_example in (examples[i % len(examples)] for i in range(no_objects if 0 < len(examples) else 0)):
+            each_object = dict(each_example)
+            words = each_object.get("text", "").split()
+            random.shuffle(words)
+            each_object["text"] = " ".join(words)
+            blocks.append(f"```json\n{json.dumps(each_object)}\n```")
+        reply = "\n\n".join(blocks) if 0 < len(blocks) else "stub reply"
+
+        prompt_tokens = len(prompt) // 4
+        completion_tokens = len(reply) // 4
+        self._send_json(200, {
+            "id": f"chatcmpl-stub-{random.getrandbits(32)}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": reply},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+
+    def log_message(self, format: str, *args: any) -> None:
+        pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a local stand-in for the chat completions endpoint.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=1., help="mean seconds per completion")
+    parser.add_argument("--requests-per-minute", type=int, default=500, help="answer with 429 above this rate")
+    arguments = parser.parse_args()
+
+    StubCompletionsHandler.latency_seconds = arguments.latency
+    StubCompletionsHandler.requests_per_minute = arguments.requests_per_minute
+
+    server = ThreadingHTTPServer(("localhost", arguments.port), StubCompletionsHandler)
+    print(f"Serving stub completions on http://localhost:{arguments.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# coding=utf-8
+import argparse
+import json
+import statistics
+import time
+
+from loguru import logger
+
+from src.database.user_manager import UserManager
+from src.dataobjects import Face
+
+
+def per_friend_reads(user_manager: UserManager, user_id: int) -> int:
+    # the former access pattern, one exists and six reads per friend
+    redis = user_manager.redis
+    no_friends = 0
+    for each_friend_id in redis.smembers(f"user:{user_id}:friends"):
+        friend_key = f"user:{each_friend_id.decode()}"
+        if not redis.exists(friend_key):
+            continue
+        for each_field in (
+                "face", "public_name", "false_positives", "true_positives", "false_negatives", "true_negatives"):
+            redis.hget(friend_key, each_field)
+        no_friends += 1
+    return no_friends
+
+
+def median_milliseconds(function: callable, repetitions: int) -> float:
+    durations = list()
+    for _ in range(repetitions):
+        started = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - started)
+    return 1_000 * statistics.median(durations)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure friend list latency for growing numbers of friends.")
+    parser.add_argument("--friends", type=int, nargs="+", default=[1, 10, 100, 1_000])
+    parser.add_argument("--repetitions", type=int, default=20)
+    parser.add_argument("--db", type=int, default=15, help="empty scratch database, flushed afterwards")
+    parser.add_argument("--config", default="../../../config.json")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, mode="r") as config_file:
+        config = json.load(config_file)
+
+    users_config = dict(config["redis"]["users_database"])
+    users_config["db"] = arguments.db
+    logger.disable("src.database")
+    user_manager = UserManager(users_config)
+    if 0 < user_manager.redis.dbsize():
+        raise ValueError(f"Database {arguments.db} is not empty.")
+
+    try:
+        user = user_manager.create_user("benchmark", Face("0"), "benchmark", -1)
+        no_friends = 0
+        print("friends\tget_friends ms\tper friend reads ms")
+        for each_count in sorted(arguments.friends):
+            while no_friends < each_count:
+                friend = user_manager.create_user(f"friend {no_friends}", Face("0"), f"friend {no_friends}", -1)
+                user_manager.make_friends(user.db_id, friend.db_id)
+                no_friends += 1
+
+            script_ms = median_milliseconds(lambda: user_manager.get_friends(user.db_id), arguments.repetitions)
+            reads_ms = median_milliseconds(lambda: per_friend_reads(user_manager, user.db_id), arguments.repetitions)
+            print(f"{each_count}\t{script_ms:.2f}\t{reads_ms:.2f}")
+
+    finally:
+        user_manager.redis.flushdb()
+
+
+if __name__ == "__main__":
+    main()
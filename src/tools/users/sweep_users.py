@@ -0,0 +1,165 @@
+# coding=utf-8
+import argparse
+import dataclasses
+import json
+import time
+from typing import Generator
+
+from loguru import logger
+
+from src.database.user_manager import UserManager
+
+
+@dataclasses.dataclass
+class SweepReport:
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    scanned_keys: int = 0
+    orphaned_friend_sets: int = 0
+    dangling_friends: int = 0
+    orphaned_name_hashes: int = 0
+    dangling_leaderboard_entries: int = 0
+
+    def report(self) -> str:
+        return (
+            f"Scanned {self.scanned_keys} keys in {time.monotonic() - self.started:.1f} seconds, removed "
+            f"{self.orphaned_friend_sets} orphaned friend sets, {self.dangling_friends} dangling friends, "
+            f"{self.orphaned_name_hashes} orphaned name hashes and "
+            f"{self.dangling_leaderboard_entries} dangling leaderboard entries."
+        )
+
+
+class UserSweeper:
+    def __init__(
+            self, user_database: UserManager, batch_size: int = 100, duty_cycle: float = .05,
+            pass_seconds: float = 60 * 60.) -> None:
+
+        if not 0. < duty_cycle <= 1.:
+            raise ValueError("Duty cycle must be greater than 0 and at most 1.")
+
+        self.redis = user_database.redis
+        self.batch_size = batch_size
+        # share of the time spent working, the pause after each batch grows with its duration
+        self.duty_cycle = duty_cycle
+        self.pass_seconds = pass_seconds
+
+        # every script only touches the keys of one scanned batch, so it never blocks the server for long
+        self._sweep_friend_sets = self.redis.register_script(
+            "local orphaned, dangling = 0, 0 "
+            "for _, friends_key in ipairs(KEYS) do "
+            "  local user_key = string.sub(friends_key, 1, -9) "
+            "  if redis.call('EXISTS', user_key) == 0 then "
+            "    redis.call('DEL', friends_key) "
+            "    orphaned = orphaned + 1 "
+            "  else "
+            "    for _, friend_id in ipairs(redis.call('SMEMBERS', friends_key)) do "
+            "      if redis.call('EXISTS', 'user:' .. friend_id) == 0 then "
+            "        redis.call('SREM', friends_key, friend_id) "
+            "        dangling = dangling + 1 "
+            "      end "
+            "    end "
+            "  end "
+            "end "
+            "return {orphaned, dangling}"
+        )
+
+        self._sweep_name_hashes = self.redis.register_script(
+            "local orphaned = 0 "
+            "for _, name_hash_key in ipairs(KEYS) do "
+            "  local user_id = redis.call('GET', name_hash_key) "
+            "  if not user_id or redis.call('EXISTS', 'user:' .. user_id) == 0 then "
+            "    redis.call('DEL', name_hash_key) "
+            "    orphaned = orphaned + 1 "
+            "  end "
+            "end "
+            "return orphaned"
+        )
+
+    def _pause(self, batch_started: float) -> None:
+        elapsed = time.monotonic() - batch_started
+        time.sleep(elapsed * (1. / self.duty_cycle - 1.))
+
+    def _batches(self, match: str) -> Generator[list[bytes], None, None]:
+        cursor = 0
+        while True:
+            batch_started = time.monotonic()
+            cursor, keys = self.redis.scan(cursor, match=match, count=self.batch_size)
+            yield keys
+            self._pause(batch_started)
+            if cursor == 0:
+                break
+
+    def _sweep_leaderboard(self, board_key: str, report: SweepReport) -> None:
+        cursor = 0
+        while True:
+            batch_started = time.monotonic()
+            cursor, entries = self.redis.zscan(board_key, cursor, count=self.batch_size)
+            user_ids = [each_user_id for each_user_id, _ in entries]
+            with self.redis.pipeline(transaction=False) as pipe:
+                for each_user_id in user_ids:
+                    pipe.exists(f"user:{each_user_id.decode()}")
+                exists = pipe.execute()
+
+            dangling = [each_user_id for each_user_id, each_exists in zip(user_ids, exists) if not each_exists]
+            if 0 < len(dangling):
+                self.redis.zrem(board_key, *dangling)
+            report.scanned_keys += len(user_ids)
+            report.dangling_leaderboard_entries += len(dangling)
+
+            self._pause(batch_started)
+            if cursor == 0:
+                break
+
+    def sweep(self) -> SweepReport:
+        report = SweepReport()
+
+        for each_batch in self._batches("user:*:friends"):
+            report.scanned_keys += len(each_batch)
+            if 0 < len(each_batch):
+                orphaned, dangling = self._sweep_friend_sets(keys=each_batch)
+                report.orphaned_friend_sets += orphaned
+                report.dangling_friends += dangling
+
+        # name hashes written before their expiration was refreshed correctly never expire on their own
+        for each_batch in self._batches("name_hash:*"):
+            report.scanned_keys += len(each_batch)
+            if 0 < len(each_batch):
+                report.orphaned_name_hashes += self._sweep_name_hashes(keys=each_batch)
+
+        for each_board in UserManager.leaderboards:
+            self._sweep_leaderboard(f"leaderboard:{each_board}", report)
+
+        return report
+
+    def run(self, once: bool = False) -> None:
+        while True:
+            report = self.sweep()
+            logger.info(report.report())
+            if once:
+                break
+            time.sleep(self.pass_seconds)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Remove expired users from friend lists and leaderboards.")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--duty-cycle", type=float, default=.05)
+    parser.add_argument("--pass-seconds", type=float, default=60 * 60.)
+    parser.add_argument("--once", action="store_true")
+    parser.add_argument("--config", default="../../../config.json")
+    arguments = parser.parse_args()
+
+    with open(arguments.config, mode="r") as config_file:
+        config = json.load(config_file)
+
+    users_config = config["redis"]["users_database"]
+    user_database = UserManager(users_config)
+
+    sweeper = UserSweeper(
+        user_database, batch_size=arguments.batch_size, duty_cycle=arguments.duty_cycle,
+        pass_seconds=arguments.pass_seconds
+    )
+    sweeper.run(once=arguments.once)
+
+
+if __name__ == "__main__":
+    main()
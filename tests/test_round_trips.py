@@ -0,0 +1,251 @@
+# coding=utf-8
+import hashlib
+from collections import Counter
+
+import fakeredis
+import pytest
+
+import src.database.marker_manager as marker_manager
+import src.database.snippet_manager as snippet_manager
+import src.database.user_manager as user_manager
+from src.database.marker_manager import MarkerManager
+from src.database.snippet_manager import SnippetManager
+from src.database.user_manager import UserManager
+from src.dataobjects import Face, Snippet, User
+
+try:
+    import src.database.invitation_manager as invitation_manager
+    from src.database.invitation_manager import InvitationManager
+except ImportError:
+    # invitation hashes are formatted by the gui tools, which need nicegui
+    invitation_manager = None
+
+
+class CountingConnection(fakeredis.FakeRedisConnection):
+    # every command and every pipeline is sent to the server in a single packed write
+    round_trips = 0
+    _connecting = False
+
+    def on_connect(self) -> None:
+        # the handshake of a new connection is not part of any read
+        self._connecting = True
+        try:
+            super().on_connect()
+        finally:
+            self._connecting = False
+
+    def send_packed_command(self, command, check_health=True) -> None:
+        if not self._connecting:
+            CountingConnection.round_trips += 1
+        super().send_packed_command(command, check_health=check_health)
+
+
+class RoundTrips:
+    def __enter__(self) -> "RoundTrips":
+        self.started = CountingConnection.round_trips
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.count = CountingConnection.round_trips - self.started
+
+
+@pytest.fixture(autouse=True)
+def fake_redis(monkeypatch: pytest.MonkeyPatch) -> None:
+    server = fakeredis.FakeServer()
+
+    def redis(**_) -> fakeredis.FakeRedis:
+        return fakeredis.FakeRedis(server=server, connection_class=CountingConnection)
+
+    for each_module in (user_manager, snippet_manager, marker_manager, invitation_manager):
+        if each_module is not None:
+            monkeypatch.setattr(each_module, "Redis", redis)
+
+
+@pytest.fixture
+def users() -> UserManager:
+    users = UserManager(dict())
+    user = users.create_user("secret", Face("0"), "user", -1)
+    for i in range(3):
+        friend = users.create_user(f"friend secret {i}", Face(str(i)), f"friend {i}", -1)
+        users.make_friends(user.db_id, friend.db_id)
+        users.save_user_state(friend, new_wins=i, new_rounds=i + 1)
+
+    # scripts are loaded with their first call, later calls only send their hash
+    users.leaderboard_cache_seconds = 0.
+    users.get_user(hashlib.sha256(b"secret").hexdigest())
+    users.get_friends(user.db_id)
+    users.get_friends_leaderboard(user.db_id)
+    users.get_leaderboard("accuracy")
+    return users
+
+
+@pytest.fixture
+def markers() -> MarkerManager:
+    markers = MarkerManager(dict(), max_markers=100)
+    markers.update_markers(Counter({"zu allgemein": 3, "wiederholung": 1}), True)
+    markers.update_markers(Counter({"zu allgemein": 1, "floskel": 2}), False)
+    return markers
+
+
+@pytest.fixture
+def snippets() -> SnippetManager:
+    snippets = SnippetManager(dict(), duplicate_threshold=None)
+    snippets.set_snippets(
+        Snippet(f"snippet number {i} with some words", "source", i % 2 == 0, (("channel", "a"),))
+        for i in range(10)
+    )
+    return snippets
+
+
+@pytest.fixture
+def invitations() -> "InvitationManager":
+    if invitation_manager is None:
+        pytest.skip("nicegui is not installed")
+    return InvitationManager(dict())
+
+
+def test_get_user(users: UserManager) -> None:
+    with RoundTrips() as round_trips:
+        user = users.get_user(hashlib.sha256(b"secret").hexdigest())
+    assert user is not None
+    assert round_trips.count == 1
+
+
+def test_get_unknown_user(users: UserManager) -> None:
+    with RoundTrips() as round_trips:
+        user = users.get_user(hashlib.sha256(b"unknown").hexdigest())
+    assert user is None
+    assert round_trips.count == 1
+
+
+def test_get_user_by_id(users: UserManager) -> None:
+    with RoundTrips() as round_trips:
+        user = users.get_user_by_id(1)
+    assert user is not None
+    assert round_trips.count == 1
+
+
+def test_get_friends(users: UserManager) -> None:
+    user = users.get_user(hashlib.sha256(b"secret").hexdigest())
+    with RoundTrips() as round_trips:
+        friends = users.get_friends(user.db_id)
+    assert len(friends) == 3
+    assert round_trips.count == 1
+
+
+def test_get_leaderboard(users: UserManager) -> None:
+    with RoundTrips() as round_trips:
+        entries = users.get_leaderboard("accuracy")
+    assert 0 < len(entries)
+    assert round_trips.count == 1
+
+
+def test_get_cached_leaderboard(users: UserManager) -> None:
+    users.leaderboard_cache_seconds = 60.
+    users.get_leaderboard("wins")
+    with RoundTrips() as round_trips:
+        users.get_leaderboard("wins")
+    assert round_trips.count == 0
+
+
+def test_get_friends_leaderboard(users: UserManager) -> None:
+    user = users.get_user(hashlib.sha256(b"secret").hexdigest())
+    with RoundTrips() as round_trips:
+        entries = users.get_friends_leaderboard(user.db_id, "wins")
+    assert 0 < len(entries)
+    assert round_trips.count == 1
+
+
+def test_get_most_successful_markers(markers: MarkerManager) -> None:
+    with RoundTrips() as round_trips:
+        most_successful = markers.get_most_successful_markers(10, 1)
+    assert ("wiederholung", 1.) in most_successful
+    assert round_trips.count == 1
+
+
+def test_get_least_successful_markers(markers: MarkerManager) -> None:
+    with RoundTrips() as round_trips:
+        least_successful = markers.get_least_successful_markers(10, 1)
+    assert ("floskel", 1.) in least_successful
+    assert round_trips.count == 1
+
+
+def test_get_markers_by_count(markers: MarkerManager) -> None:
+    with RoundTrips() as round_trips:
+        by_count = markers.get_markers_by_count(2)
+    assert by_count[0] == ("zu allgemein", 4)
+    assert round_trips.count == 1
+
+
+def test_get_snippet(snippets: SnippetManager) -> None:
+    with RoundTrips() as round_trips:
+        snippet = snippets.get_snippet(1)
+    assert snippet.text == "snippet number 1 with some words"
+    assert round_trips.count == 1
+
+
+def test_get_cached_snippet(snippets: SnippetManager) -> None:
+    snippets.get_snippet(1)
+    with RoundTrips() as round_trips:
+        snippets.get_snippet(1)
+    assert round_trips.count == 0
+
+
+def test_get_statistics(snippets: SnippetManager) -> None:
+    with RoundTrips() as round_trips:
+        statistics = snippets.get_statistics()
+    assert statistics["bots"] == statistics["humans"] == 5
+    assert round_trips.count == 1
+
+
+@pytest.mark.parametrize("is_bot", [None, True, False])
+def test_get_random_snippet_ids(snippets: SnippetManager, is_bot: bool | None) -> None:
+    with RoundTrips() as round_trips:
+        snippet_ids = snippets.get_random_snippet_ids(4, is_bot=is_bot)
+    assert len(snippet_ids) == 4
+    assert round_trips.count == 1
+
+
+def test_get_next_snippet(snippets: SnippetManager) -> None:
+    user = User("secret", "user", db_id=1)
+    # the first draw shuffles the deck
+    snippets.get_next_snippet(user)
+    snippets.cache.clear()
+    with RoundTrips() as round_trips:
+        snippets.get_next_snippet(user)
+    # one for the cursor and one for the snippet
+    assert round_trips.count == 2
+
+
+def test_get_next_cached_snippet(snippets: SnippetManager) -> None:
+    user = User("secret", "user", db_id=1)
+    for _ in range(11):
+        snippets.get_next_snippet(user)
+
+    # the second cycle has been shuffled and finds every snippet in the cache
+    with RoundTrips() as round_trips:
+        snippets.get_next_snippet(user)
+    assert round_trips.count == 1
+
+
+def test_get_invitee_id(invitations: "InvitationManager") -> None:
+    invitation_hash = invitations.create_invitation_hash(User("secret", "user", db_id=7))
+    with RoundTrips() as round_trips:
+        invitee_id = invitations.get_invitee_id(invitation_hash)
+    assert invitee_id == 7
+    assert round_trips.count == 1
+
+
+def test_get_unknown_invitee_id(invitations: "InvitationManager") -> None:
+    with RoundTrips() as round_trips:
+        invitee_id = invitations.get_invitee_id("unknown")
+    assert invitee_id is None
+    assert round_trips.count == 1
+
+
+def test_remove_invitation_link(invitations: "InvitationManager") -> None:
+    invitation_hash = invitations.create_invitation_hash(User("secret", "user", db_id=7))
+    with RoundTrips() as round_trips:
+        invitations.remove_invitation_link(invitation_hash)
+    assert invitations.get_invitee_id(invitation_hash) is None
+    assert round_trips.count == 1
@@ -0,0 +1,79 @@
+# coding=utf-8
+import asyncio
+
+import fakeredis
+import pytest
+
+import src.database.snippet_manager as snippet_manager
+from src.database.snippet_manager import SnippetManager, _permute
+from src.dataobjects import Snippet, User
+
+
+@pytest.fixture
+def redis(monkeypatch: pytest.MonkeyPatch) -> fakeredis.FakeRedis:
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(snippet_manager, "Redis", lambda **_: fakeredis.FakeRedis(server=server))
+    return fakeredis.FakeRedis(server=server)
+
+
+@pytest.fixture
+def snippets(redis: fakeredis.FakeRedis) -> SnippetManager:
+    snippets = SnippetManager(dict(), duplicate_threshold=None, progress_expiration_seconds=600)
+    snippets.set_snippets(Snippet(f"snippet number {i}", "source", i % 3 == 0, ()) for i in range(25))
+    return snippets
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 100, 1_000, 4_097])
+@pytest.mark.parametrize("seed", [0, 1, 0xFFFFFFFF])
+def test_permutation_is_bijection(size: int, seed: int) -> None:
+    assert sorted(_permute(i, size, seed) for i in range(size)) == list(range(size))
+
+
+def test_seeds_shuffle_differently() -> None:
+    orders = {tuple(_permute(i, 100, each_seed) for i in range(100)) for each_seed in range(10)}
+    assert 1 < len(orders)
+
+
+def test_deck_does_not_repeat_within_cycle(snippets: SnippetManager) -> None:
+    user = User("secret", "user", db_id=1)
+    first_cycle = [snippets.get_next_snippet(user).db_id for _ in range(25)]
+    assert sorted(first_cycle) == list(range(25))
+
+    second_cycle = [snippets.get_next_snippet(user).db_id for _ in range(25)]
+    assert sorted(second_cycle) == list(range(25))
+
+
+@pytest.mark.parametrize("is_bot", [True, False])
+def test_class_deck_does_not_repeat_within_cycle(snippets: SnippetManager, is_bot: bool) -> None:
+    snippets.bot_ratio = 1. if is_bot else 0.
+    user = User("secret", "user", db_id=1)
+    class_ids = [i for i in range(25) if (i % 3 == 0) == is_bot]
+    drawn = [snippets.get_next_snippet(user).db_id for _ in class_ids]
+    assert sorted(drawn) == class_ids
+
+
+def test_deck_skips_removed_snippets(snippets: SnippetManager) -> None:
+    for each_id in (0, 5, 24):
+        snippets.remove_snippet(each_id)
+
+    user = User("secret", "user", db_id=1)
+    drawn = [snippets.get_next_snippet(user).db_id for _ in range(22)]
+    assert sorted(drawn) == [i for i in range(25) if i not in (0, 5, 24)]
+
+
+def test_progress_expires(snippets: SnippetManager, redis: fakeredis.FakeRedis) -> None:
+    user = User("secret", "user", db_id=1)
+    snippets.get_next_snippet(user)
+    assert 0 < redis.ttl("user:1:progress") <= 600
+
+
+def test_prefetched_deck_does_not_repeat_within_cycle(snippets: SnippetManager) -> None:
+    prefetcher = snippets.create_prefetcher(User("secret", "user", db_id=1))
+
+    async def draw() -> list[int]:
+        return [(await prefetcher.get_next_snippet()).db_id for _ in range(25)]
+
+    try:
+        assert sorted(asyncio.run(draw())) == list(range(25))
+    finally:
+        prefetcher.close()